@@ -0,0 +1,255 @@
+""" Cached analytics queries
+
+Serves the common analytics of `sparkifydb` (top songs of a period, a user's
+listening history, and hourly activity) from an in-process result cache, so
+repeated calls do not reach Postgres.
+
+The cache holds the most recently used results for at most `ttl` seconds.
+Every loader advances the load generation of the tables it changed in the
+same transaction (see `etl.bump_load_generation`), and Postgres notifies the
+`sparkify_load` listeners on commit. Before each call the notifications that
+arrived are read from the connection without a round trip, and a cached
+result is only served while the generations of the tables it read are
+unchanged.
+
+A notification can still be on its way when a call starts, so the current
+generations are also read from `load_generation` once they are `max_lag`
+seconds old. A call therefore reflects every load committed at least
+`max_lag` seconds before it; with `max_lag=0` it reflects every committed
+load, at the cost of one round trip per call. The TTL bounds the age of
+results if tables are changed outside of the loaders.
+"""
+
+import time
+import argparse
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import psycopg2
+from sql_queries import load_generation_listen, load_generation_select, \
+                        analytics_top_songs_select, \
+                        analytics_user_history_select, plays_per_hour_select
+from etl import SPARKIFY_DSN
+
+
+class QueryCache:
+    """ LRU cache of query results that expire after `ttl` seconds.
+
+    Each result is stored with the load generations it was read at, and is
+    only returned while they are current.
+
+    Attributes:
+        maxsize (int): number of results kept, least recently used dropped
+        ttl (float): seconds a result is kept
+        entries (collections.OrderedDict): key to (result, generations,
+            expiry), least recently used first
+        hits (int): number of results served from the cache
+        misses (int): number of lookups without a current result
+    """
+
+    def __init__(self, maxsize=256, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generations):
+        """ Returns the cached result of `key`, or `None` if not current.
+
+        Args:
+            key (tuple): query name and parameters
+            generations (tuple): current generations of the tables read
+        Returns:
+            list: the cached rows, or `None`
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[1] != generations or \
+           entry[2] < time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, generations, result):
+        """ Stores `result` of `key` as read at `generations`. """
+        self.entries[key] = (result, generations, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """ Drops all cached results. """
+        self.entries.clear()
+
+
+class Analytics:
+    """ Analytics queries over `sparkifydb` behind a `QueryCache`.
+
+    The connection is in autocommit mode, so notifications are received
+    between queries. After the connection was lost it is reopened on the next
+    call, reading the generations again, since notifications may have been
+    missed.
+
+    Attributes:
+        dsn (str): connection string of the database
+        cache (QueryCache): results of earlier calls
+        max_lag (float): seconds after which the generations are read again
+        generations (dict): load generation name to its current value
+        read_at (float): `time.monotonic()` of the last read of generations
+    """
+
+    def __init__(self, dsn=SPARKIFY_DSN, maxsize=256, ttl=300.0, \
+                 max_lag=1.0):
+        self.dsn = dsn
+        self.cache = QueryCache(maxsize, ttl)
+        self.max_lag = max_lag
+        self.conn = None
+        self.generations = {}
+        self.read_at = None
+        self.connect()
+
+    def connect(self):
+        """ Opens the connection and listens for loads. """
+        self.conn = psycopg2.connect(self.dsn)
+        self.conn.autocommit = True
+        with self.conn.cursor() as cur:
+            cur.execute(load_generation_listen)
+        self.read_at = None
+
+    def refresh(self):
+        """ Applies the load notifications received since the last call.
+
+        The generations are read from `load_generation` instead once they are
+        `max_lag` seconds old, covering loads whose notification is still on
+        its way.
+
+        Returns:
+            `None`: actions performed, but no return value
+        """
+        if self.conn.closed:
+            self.connect()
+
+        # listening started before the read, so no load commits unnoticed
+        now = time.monotonic()
+        if self.read_at is None or now - self.read_at >= self.max_lag:
+            with self.conn.cursor() as cur:
+                cur.execute(load_generation_select)
+                self.generations = dict(cur.fetchall())
+            self.read_at = now
+
+        self.conn.poll()
+        while self.conn.notifies:
+            name, generation = self.conn.notifies.pop(0).payload \
+                                   .rsplit(':', 1)
+            self.generations[name] = max(self.generations.get(name, 0), \
+                                         int(generation))
+
+    def query(self, name, tables, sql, params):
+        """ Returns the rows of `sql`, from the cache while it is current.
+
+        Args:
+            name (str): name of the query in the cache key
+            tables (tuple): load generations of the tables `sql` reads
+            sql (str): query of `sql_queries`
+            params (tuple): query parameters
+        Returns:
+            list: result rows
+        """
+        self.refresh()
+        key = (name,) + tuple(params)
+        generations = tuple(self.generations.get(table, 0) \
+                            for table in tables)
+
+        rows = self.cache.get(key, generations)
+        if rows is None:
+            with self.conn.cursor() as cur:
+                cur.execute(sql, params)
+                rows = cur.fetchall()
+            self.cache.put(key, generations, rows)
+        return rows
+
+    def top_songs(self, start, end, limit=10):
+        """ Returns the most played songs of a period.
+
+        Args:
+            start (datetime.datetime): start of the period
+            end (datetime.datetime): end of the period, excluded
+            limit (int): number of songs returned
+        Returns:
+            list: (title, artist name, plays), most plays first
+        """
+        return self.query('top_songs', ('songs', 'songplays'), \
+                          analytics_top_songs_select, (start, end, limit))
+
+    def user_history(self, user_id, limit=50):
+        """ Returns the latest songplays of a user.
+
+        Args:
+            user_id (int): ID of the user
+            limit (int): number of songplays returned
+        Returns:
+            list: (start_time, title, artist name, level, session_id), latest
+                first; title and artist are `None` for unmatched songs
+        """
+        return self.query('user_history', ('songs', 'songplays'), \
+                          analytics_user_history_select, (user_id, limit))
+
+    def hourly_activity(self, start, end):
+        """ Returns (hour, plays) for every hour with plays in a period.
+
+        Read from the `hourly_plays` rollup, so plays appear once `etl.py`
+        or `watch.py` updated the rollups.
+        """
+        return self.query('hourly_activity', ('rollups',), \
+                          plays_per_hour_select, (start, end))
+
+    def close(self):
+        """ Closes the connection. """
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the cached analytics '
+                                                 'queries against the '
+                                                 'sparkifydb database.')
+    parser.add_argument('--start', default='2018-11-01',
+                        help='first day, as YYYY-MM-DD')
+    parser.add_argument('--days', type=int, default=30,
+                        help='number of days in the period')
+    parser.add_argument('--user', type=int,
+                        help='user whose history is listed')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of times each query is called')
+    parser.add_argument('--max-lag', type=float, default=1.0,
+                        help='seconds after which the load generations are '
+                             'read again, 0 to read them on every call')
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, '%Y-%m-%d')
+    end = start + timedelta(days=args.days)
+
+    analytics = Analytics(max_lag=args.max_lag)
+    calls = [('top songs', lambda: analytics.top_songs(start, end)),
+             ('hourly activity', \
+              lambda: analytics.hourly_activity(start, end))]
+    if args.user is not None:
+        calls.append(('user history', \
+                      lambda: analytics.user_history(args.user)))
+
+    for label, call in calls:
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            rows = call()
+            print('{:<16} {:>6} rows in {:>8.2f} ms'.format(label, len(rows), \
+                  (time.perf_counter() - started) * 1000))
+
+    print('{} hits, {} misses, generations {}'.format( \
+          analytics.cache.hits, analytics.cache.misses, analytics.generations))
+    analytics.close()
+
+
+if __name__ == "__main__":
+    main()
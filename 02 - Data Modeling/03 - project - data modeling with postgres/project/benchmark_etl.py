@@ -0,0 +1,198 @@
+""" ETL benchmark
+
+Recreates the tables in `sparkifydb`, loads a song and log data tree (e.g.
+one written by `generate_data.py`) with the functions of `etl.py`, and reports
+files/s and rows/s per table. Each result is appended to a JSON lines file and
+compared with the last result for the same data and settings, so regressions
+show up between versions.
+"""
+
+import os
+import json
+import time
+import argparse
+import subprocess
+from functools import partial
+from datetime import datetime
+import psycopg2
+from create_tables import drop_tables, create_tables, create_indexes
+from etl import SPARKIFY_DSN, TimeCache, iter_json_files, process_data, \
+                process_song_file, process_log_file, build_song_index, \
+                merge_user_events, split_default_partition, update_rollups
+
+
+# tables counted after each phase of the load
+PHASE_TABLES = {'song_data': ['songs', 'artists'],
+                'log_data': ['time', 'users', 'songplays']}
+# drop in files/s, as a fraction of the previous result, reported as regression
+REGRESSION_THRESHOLD = 0.1
+
+
+def count_files(filepath):
+    """ Returns the number of input files in the tree rooted at `filepath`.
+
+    Counts what `etl.py` loads as one file each: JSON files, compressed JSON
+    files, and archives (see `etl.iter_json_files`).
+    """
+    return sum(1 for datafile in iter_json_files(filepath))
+
+
+def count_rows(cur, table):
+    """ Returns the number of rows in `table`. """
+    cur.execute('SELECT COUNT(*) FROM {}'.format(table))
+    return cur.fetchone()[0]
+
+
+def git_revision():
+    """ Returns the short hash of the checked out commit, if there is one. """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], \
+                                       stderr=subprocess.DEVNULL) \
+                         .decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(cur, conn, data, settings):
+    """ Loads the song and log trees under `data` into empty tables.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        conn (psycopg2 connection): connection to database
+        data (str): directory containing `song_data` and `log_data`
+        settings (dict): `workers`, `bulk`, `batch_files`, and `batch_rows`
+            as accepted by `etl.py`
+    Returns:
+        dict: files, seconds, files/s, and rows and rows/s per table for
+            each phase
+    """
+    # the same schema as `create_tables.py`, indexes included
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    create_indexes(cur, conn)
+
+    load_options = {'workers': settings['workers'], \
+                    'batch_files': settings['batch_files'], \
+                    'batch_rows': settings['batch_rows']}
+    results = {}
+    for phase in ['song_data', 'log_data']:
+        filepath = os.path.join(data, phase)
+
+        start = time.perf_counter()
+        if phase == 'song_data':
+            process_data(cur, conn, filepath, process_song_file, \
+                         generation='songs', **load_options)
+        else:
+            func = partial(process_log_file, song_index=build_song_index(cur), \
+                           bulk=settings['bulk'], time_cache=TimeCache())
+            process_data(cur, conn, filepath, func, generation='songplays', \
+                         **load_options)
+            merge_user_events(cur, conn)
+            split_default_partition(cur, conn)
+            update_rollups(cur, conn)
+        seconds = time.perf_counter() - start
+
+        files = count_files(filepath)
+        results[phase] = {'files': files,
+                          'seconds': seconds,
+                          'files_per_second': files / seconds,
+                          'tables': {}}
+        for table in PHASE_TABLES[phase]:
+            rows = count_rows(cur, table)
+            results[phase]['tables'][table] = {'rows': rows,
+                                               'rows_per_second': rows / seconds}
+    return results
+
+
+def previous_result(results_file, data, settings):
+    """ Returns the latest saved result for the same data and settings.
+
+    Args:
+        results_file (str): filepath of the JSON lines results file
+        data (str): directory containing `song_data` and `log_data`
+        settings (dict): settings passed to `run_benchmark`
+    Returns:
+        dict: the saved result, or `None` if there is none
+    """
+    if not os.path.exists(results_file):
+        return None
+
+    previous = None
+    with open(results_file) as f:
+        for line in f:
+            result = json.loads(line)
+            if result['data'] == data and result['settings'] == settings:
+                previous = result
+    return previous
+
+
+def print_report(result, previous):
+    """ Prints the throughput of each phase and flags regressions.
+
+    Args:
+        result (dict): result of this run
+        previous (dict): earlier result to compare with, or `None`
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    for phase, phase_result in result['phases'].items():
+        print('{}: {} files in {:.2f}s, {:.1f} files/s'.format(phase, \
+              phase_result['files'], phase_result['seconds'], \
+              phase_result['files_per_second']))
+        for table, table_result in phase_result['tables'].items():
+            print('    {:<10} {:>10} rows {:>12.1f} rows/s'.format(table, \
+                  table_result['rows'], table_result['rows_per_second']))
+
+        if previous:
+            before = previous['phases'][phase]['files_per_second']
+            change = (phase_result['files_per_second'] - before) / before
+            print('    {:+.1%} files/s compared to {} ({})'.format(change, \
+                  previous['revision'], previous['timestamp']))
+            if change < -REGRESSION_THRESHOLD:
+                print('    REGRESSION: {} is {:.1%} slower'.format(phase, \
+                      -change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks etl.py against a '
+                                                 'local sparkifydb.')
+    parser.add_argument('--data', default='data_generated',
+                        help='directory containing song_data and log_data')
+    parser.add_argument('--results', default='benchmarks/etl_results.jsonl',
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--bulk', action='store_true',
+                        help='load log files with COPY and set-based merges')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes loading files in parallel')
+    parser.add_argument('--batch-files', type=int, default=1,
+                        help='number of files committed together')
+    parser.add_argument('--batch-rows', type=int,
+                        help='also commit once this many rows were loaded')
+    args = parser.parse_args()
+
+    settings = {'bulk': args.bulk,
+                'workers': args.workers,
+                'batch_files': args.batch_files,
+                'batch_rows': args.batch_rows}
+    data = os.path.abspath(args.data)
+
+    conn = psycopg2.connect(SPARKIFY_DSN)
+    cur = conn.cursor()
+
+    result = {'timestamp': datetime.now().isoformat(timespec='seconds'),
+              'revision': git_revision(),
+              'data': data,
+              'settings': settings,
+              'phases': run_benchmark(cur, conn, data, settings)}
+
+    conn.close()
+
+    print_report(result, previous_result(args.results, data, settings))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+""" Analytical query benchmark
+
+Runs the analyst queries of `sql_queries.benchmark_queries` against a loaded
+`sparkifydb`, reports latency percentiles, and captures each query's
+`EXPLAIN (ANALYZE, BUFFERS)` plan. Results are appended to a JSON lines file.
+Each run is compared with the previous one, so a changed plan shape (e.g. a
+new sequential scan after an index or partitioning change) or a slower query
+shows up between versions.
+"""
+
+import os
+import json
+import time
+import difflib
+import argparse
+from datetime import datetime
+import numpy as np
+import psycopg2
+from sql_queries import benchmark_queries, benchmark_song_select
+from etl import SPARKIFY_DSN
+from benchmark_etl import git_revision
+
+
+PERCENTILES = [50, 90, 99]
+# increase in p50 latency, as a fraction of the previous result, reported as
+# regression
+REGRESSION_THRESHOLD = 0.2
+
+
+def plan_shape(plan, depth=0):
+    """ Returns the node types of a JSON plan as indented lines.
+
+    Only the shape is kept: node type, relation or index, and join or scan
+    direction, without costs, row counts, or timings that vary between runs.
+    Partitions of `songplays` show up as their own scan nodes, so a change in
+    partition pruning changes the shape too.
+
+    Args:
+        plan (dict): a `Plan` node of `EXPLAIN (FORMAT JSON)` output
+        depth (int): nesting depth of `plan`
+    Returns:
+        list: one line per plan node, in pre-order
+    """
+    label = plan['Node Type']
+    if 'Join Type' in plan:
+        label += ' ' + plan['Join Type']
+    if 'Index Name' in plan:
+        label += ' using ' + plan['Index Name']
+    if 'Relation Name' in plan:
+        label += ' on ' + plan['Relation Name']
+
+    lines = ['  ' * depth + label]
+    for child in plan.get('Plans', []):
+        lines.extend(plan_shape(child, depth + 1))
+    return lines
+
+
+def explain(cur, query, params):
+    """ Runs `query` under `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)`.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        query (str): query of `benchmark_queries`
+        params (dict): query parameters
+    Returns:
+        dict: the plan, its shape from `plan_shape`, the execution time, and
+            the shared buffers hit and read
+    """
+    cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params)
+    result = cur.fetchone()[0][0]
+    plan = result['Plan']
+    return {'plan': plan,
+            'shape': plan_shape(plan),
+            'execution_ms': result['Execution Time'],
+            'shared_hit_blocks': plan.get('Shared Hit Blocks', 0),
+            'shared_read_blocks': plan.get('Shared Read Blocks', 0)}
+
+
+def time_query(cur, query, params, warmup, repeat):
+    """ Returns the latency percentiles of `query` in milliseconds.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        query (str): query of `benchmark_queries`
+        params (dict): query parameters
+        warmup (int): number of untimed runs first
+        repeat (int): number of timed runs
+    Returns:
+        dict: mean, percentiles, and maximum latency, and the rows returned
+    """
+    for _ in range(warmup):
+        cur.execute(query, params)
+        cur.fetchall()
+
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    values = np.array(latencies)
+    stats = {'rows': len(rows), 'mean_ms': values.mean(), \
+             'max_ms': values.max()}
+    for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        stats['p{}_ms'.format(p)] = value
+    return stats
+
+
+def run_benchmark(cur, params, warmup, repeat):
+    """ Times and explains every query of `benchmark_queries`.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        params (dict): query parameters
+        warmup (int): number of untimed runs per query
+        repeat (int): number of timed runs per query
+    Returns:
+        dict: query name to its latency stats and plan
+    """
+    results = {}
+    for name, query in benchmark_queries.items():
+        results[name] = time_query(cur, query, params, warmup, repeat)
+        results[name].update(explain(cur, query, params))
+    return results
+
+
+def previous_result(results_file, params):
+    """ Returns the latest saved result for the same query parameters. """
+    if not os.path.exists(results_file):
+        return None
+
+    previous = None
+    with open(results_file) as f:
+        for line in f:
+            result = json.loads(line)
+            if result['params'] == params:
+                previous = result
+    return previous
+
+
+def print_report(result, previous):
+    """ Prints the latency of each query and flags plan and speed changes.
+
+    Args:
+        result (dict): result of this run
+        previous (dict): earlier result to compare with, or `None`
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    header = ['query', 'rows', 'mean ms'] + \
+             ['p{} ms'.format(p) for p in PERCENTILES] + ['max ms', 'buffers']
+    print(('{:<18}' + ' {:>10}' * (len(header) - 1)).format(*header))
+
+    for name, stats in result['queries'].items():
+        values = [stats['mean_ms']] + \
+                 [stats['p{}_ms'.format(p)] for p in PERCENTILES] + \
+                 [stats['max_ms']]
+        buffers = stats['shared_hit_blocks'] + stats['shared_read_blocks']
+        print(('{:<18} {:>10}' + ' {:>10.2f}' * len(values) + ' {:>10}') \
+              .format(name, stats['rows'], *values, buffers))
+
+        before = previous and previous['queries'].get(name)
+        if not before:
+            continue
+
+        change = (stats['p50_ms'] - before['p50_ms']) / before['p50_ms']
+        if change > REGRESSION_THRESHOLD:
+            print('    REGRESSION: p50 {:+.1%} compared to {} ({})'.format( \
+                  change, previous['revision'], previous['timestamp']))
+
+        if stats['shape'] != before['shape']:
+            new_scans = [line.strip() for line in stats['shape'] \
+                         if 'Seq Scan' in line and line not in before['shape']]
+            print('    PLAN CHANGE compared to {} ({}){}'.format( \
+                  previous['revision'], previous['timestamp'], \
+                  ', new ' + '; '.join(new_scans) if new_scans else ''))
+            for line in difflib.unified_diff(before['shape'], stats['shape'], \
+                                             'before', 'after', lineterm=''):
+                print('        ' + line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks analytical '
+                                                 'queries against a local '
+                                                 'sparkifydb.')
+    parser.add_argument('--start', default='2018-11-01',
+                        help='first day of the queried range, as YYYY-MM-DD')
+    parser.add_argument('--end', default='2018-12-01',
+                        help='day after the queried range, as YYYY-MM-DD')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='number of untimed runs per query')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of timed runs per query')
+    parser.add_argument('--results', default='benchmarks/query_results.jsonl',
+                        help='JSON lines file the results are appended to')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(SPARKIFY_DSN)
+    conn.set_session(readonly=True)
+    cur = conn.cursor()
+
+    # the song lookup is timed with a song that exists
+    cur.execute(benchmark_song_select)
+    title, artist, length = cur.fetchone() or (None, None, None)
+    params = {'start': args.start, 'end': args.end, \
+              'title': title, 'artist': artist, 'length': length}
+
+    result = {'timestamp': datetime.now().isoformat(timespec='seconds'),
+              'revision': git_revision(),
+              'params': {'start': args.start, 'end': args.end},
+              'queries': run_benchmark(cur, params, args.warmup, args.repeat)}
+
+    conn.close()
+
+    print_report(result, previous_result(args.results, result['params']))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(result, default=str) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+""" JSON reader micro-benchmark
+
+Times the per-file cost of reading the `data/song_data` and `data/log_data`
+trees with `pandas.read_json`, as `etl.py` used to, against the
+`read_json_lines` fast path. No database connection is needed.
+"""
+
+import os
+import glob
+import timeit
+import argparse
+import pandas as pd
+from etl import read_json_lines, LOG_COLUMNS
+
+
+def read_song_pandas(filepath):
+    """ Reads the song and artist record of a song file with pandas. """
+    df = pd.read_json(filepath, lines=True)
+    song_data = df[['song_id', 'title', 'artist_id', \
+                    'year', 'duration']].values.tolist()[0]
+    artist_data = df[['artist_id', 'artist_name', 'artist_location', \
+                      'artist_latitude', 'artist_longitude']].values.tolist()[0]
+    return song_data, artist_data
+
+
+def read_song_fast(filepath):
+    """ Reads the song and artist records of a song file as tuples. """
+    return [((r['song_id'], r['title'], r['artist_id'], r['year'], \
+              r['duration']), \
+             (r['artist_id'], r['artist_name'], r['artist_location'], \
+              r['artist_latitude'], r['artist_longitude'])) \
+            for r in read_json_lines(filepath)]
+
+
+def read_log_pandas(filepath):
+    """ Reads the NextSong events of a log file with pandas. """
+    df = pd.read_json(filepath, lines=True, \
+                      convert_dates=['ts'], date_unit='ms')
+    return df[df.page == 'NextSong']
+
+
+def read_log_fast(filepath):
+    """ Reads the NextSong events of a log file into a narrow DataFrame. """
+    records = [record for record in read_json_lines(filepath) \
+               if record.get('page') == 'NextSong']
+    df = pd.DataFrame.from_records(records, columns=LOG_COLUMNS)
+    df['ts'] = pd.to_datetime(df.ts, unit='ms')
+    return df
+
+
+def time_per_file(reader, files, repeat):
+    """ Returns the best average time in seconds `reader` spent per file.
+
+    Args:
+        reader (function): function object called on each file
+        files (list): filepaths of the files to read
+        repeat (int): number of passes over `files`, the fastest is kept
+    Returns:
+        float: seconds per file
+    """
+    timings = timeit.repeat(lambda: [reader(f) for f in files], \
+                            repeat=repeat, number=1)
+    return min(timings) / len(files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the per-file cost '
+                                                 'of the JSON readers.')
+    parser.add_argument('--data', default='data',
+                        help='directory containing song_data and log_data')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed passes over each tree')
+    args = parser.parse_args()
+
+    benchmarks = [('song_data', read_song_pandas, read_song_fast),
+                  ('log_data', read_log_pandas, read_log_fast)]
+
+    print('{:<10} {:>6} {:>14} {:>14} {:>8}'.format('tree', 'files', \
+          'pandas (ms)', 'fast (ms)', 'speedup'))
+    for tree, before, after in benchmarks:
+        files = glob.glob(os.path.join(args.data, tree, '**', '*.json'), \
+                          recursive=True)
+        before_time = time_per_file(before, files, args.repeat)
+        after_time = time_per_file(after, files, args.repeat)
+        print('{:<10} {:>6} {:>14.3f} {:>14.3f} {:>7.1f}x'.format(tree, \
+              len(files), before_time * 1000, after_time * 1000, \
+              before_time / after_time))
+
+
+if __name__ == "__main__":
+    main()
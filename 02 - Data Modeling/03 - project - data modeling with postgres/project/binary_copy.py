@@ -0,0 +1,140 @@
+""" Binary COPY encoder
+
+Encodes column arrays into the PostgreSQL binary `COPY` format, so rows can be
+loaded with `COPY ... FROM STDIN WITH (FORMAT binary)` without formatting
+each value as text for the server to parse back. Fixed-width columns are
+converted and scattered into the output buffer with NumPy; only text columns
+are encoded to UTF-8 value by value.
+
+Format: an 11-byte signature, 32-bit flags and header extension length, then
+per row a 16-bit field count and per field a 32-bit byte length (-1 for
+`NULL`) followed by the value in network byte order, and a 16-bit -1 trailer.
+"""
+
+import io
+import numpy as np
+import pandas as pd
+
+
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+HEADER = SIGNATURE + np.array([0, 0], dtype='>i4').tobytes()
+TRAILER = np.array([-1], dtype='>i2').tobytes()
+
+# Postgres timestamps count microseconds since 2000-01-01
+POSTGRES_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+
+# binary value type of each fixed-width Postgres type
+FIXED_TYPES = {'int2': '>i2', 'int4': '>i4', 'int8': '>i8', \
+               'float4': '>f4', 'float8': '>f8', 'timestamp': '>i8'}
+
+
+def encode_fixed(kind, values):
+    """ Returns the values of a fixed-width column as big-endian bytes.
+
+    Args:
+        kind (str): a key of `FIXED_TYPES`
+        values (numpy.ndarray): numbers, or `datetime64` for `timestamp`
+    Returns:
+        `numpy.ndarray`: one row of `uint8` per value
+    """
+    if kind == 'timestamp':
+        values = (values.astype('datetime64[us]') - POSTGRES_EPOCH) \
+                 .astype(np.int64)
+    encoded = np.ascontiguousarray(values, dtype=FIXED_TYPES[kind])
+    return encoded.view(np.uint8).reshape(len(values), encoded.itemsize)
+
+
+def encode_text(values):
+    """ Returns the UTF-8 bytes of a text column and their lengths.
+
+    Args:
+        values (numpy.ndarray): `str` objects, `None` or `NaN` for `NULL`
+    Returns:
+        tuple: all values concatenated as `numpy.ndarray` of `uint8`, and
+            the byte length of each value with -1 for `NULL`
+    """
+    encoded = [value.encode('utf-8') if isinstance(value, str) else None \
+               for value in values]
+    lengths = np.array([-1 if value is None else len(value) \
+                        for value in encoded], dtype=np.int64)
+    blob = np.frombuffer(b''.join(value for value in encoded if value), \
+                         dtype=np.uint8)
+    return blob, lengths
+
+
+def encode_rows(columns):
+    """ Encodes columns into the binary `COPY` format.
+
+    Args:
+        columns (list): (kind, values) per column in `COPY` order, where kind
+            is a key of `FIXED_TYPES` or `text`, and values is an array or
+            `pandas.Series` with one value per row; `None`, `NaN`, `NaT`, and
+            `NA` are sent as `NULL`
+    Returns:
+        bytes: header, rows, and trailer
+    """
+    num_rows = len(columns[0][1]) if columns else 0
+    fields = []
+    for kind, values in columns:
+        values = np.asarray(values)
+        if kind == 'text':
+            blob, lengths = encode_text(values)
+        else:
+            # nulls are encoded as zero, but only their length is written
+            null = pd.isna(values)
+            blob = encode_fixed(kind, np.where(null, np.zeros(1, values.dtype), \
+                                               values))
+            lengths = np.where(null, -1, blob.shape[1]).astype(np.int64)
+        fields.append((kind, blob, lengths))
+
+    # field sizes per row, with their 4-byte length prefix
+    sizes = np.column_stack([4 + np.maximum(lengths, 0) \
+                             for kind, blob, lengths in fields]) \
+            if fields else np.zeros((num_rows, 0), dtype=np.int64)
+    row_sizes = 2 + sizes.sum(axis=1)
+    row_starts = len(HEADER) + np.cumsum(row_sizes) - row_sizes
+    total = len(HEADER) + int(row_sizes.sum()) + len(TRAILER)
+
+    buffer = np.zeros(total, dtype=np.uint8)
+    buffer[:len(HEADER)] = np.frombuffer(HEADER, dtype=np.uint8)
+    buffer[total - len(TRAILER):] = np.frombuffer(TRAILER, dtype=np.uint8)
+
+    def scatter(starts, data):
+        # writes row i of data at byte offset starts[i]
+        width = data.shape[1]
+        buffer[starts[:, None] + np.arange(width)] = data
+
+    field_count = np.full(num_rows, len(fields), dtype='>i2')
+    scatter(row_starts, field_count.view(np.uint8).reshape(num_rows, 2))
+
+    field_starts = row_starts + 2
+    for index, (kind, blob, lengths) in enumerate(fields):
+        prefix = lengths.astype('>i4').view(np.uint8).reshape(num_rows, 4)
+        scatter(field_starts, prefix)
+        data_starts = field_starts + 4
+
+        if kind == 'text':
+            # every byte of the blob moves by the offset of its row
+            present = np.maximum(lengths, 0)
+            shift = data_starts - (np.cumsum(present) - present)
+            buffer[np.arange(len(blob)) + np.repeat(shift, present)] = blob
+        else:
+            present = lengths >= 0
+            scatter(data_starts[present], blob[present])
+
+        field_starts = field_starts + sizes[:, index]
+
+    return buffer.tobytes()
+
+
+def copy_binary(cur, query, columns):
+    """ Streams columns into Postgres with a single binary `COPY FROM STDIN`.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        query (str): `COPY ... FROM STDIN WITH (FORMAT binary)` statement
+        columns (list): (kind, values) per column, see `encode_rows`
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    cur.copy_expert(query, io.BytesIO(encode_rows(columns)))
@@ -6,7 +6,8 @@ and `README.md`.
 """
 
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, \
+                        create_index_queries, drop_index_queries
 
 
 def create_database():
@@ -41,11 +42,24 @@ def create_tables(cur, conn):
         conn.commit()
 
 
+def drop_indexes(cur, conn):
+    for query in drop_index_queries:
+        cur.execute(query)
+        conn.commit()
+
+
+def create_indexes(cur, conn):
+    for query in create_index_queries:
+        cur.execute(query)
+        conn.commit()
+
+
 def main():
     cur, conn = create_database()
     
     drop_tables(cur, conn)
     create_tables(cur, conn)
+    create_indexes(cur, conn)
 
     conn.close()
 
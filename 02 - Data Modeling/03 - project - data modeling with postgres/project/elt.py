@@ -0,0 +1,150 @@
+""" ELT pipeline
+
+Tells Postgres to `COPY` the JSON lines of the `data/song_data` and
+`data/log_data` trees unchanged into `jsonb` staging tables, then transforms
+and inserts them into the schema defined in `sql_queries.py` and `README.md`
+with set-based `INSERT` ... `SELECT` statements, like the Redshift pipeline.
+No row passes through pandas.
+"""
+
+import os
+import time
+import argparse
+import psycopg2
+from sql_queries import *
+from inputs import InputStream, INPUT_ERRORS
+from etl import SPARKIFY_DSN, MATCH_TOLERANCE, iter_json_files, \
+                pending_files, begin_file, split_default_partition, \
+                update_rollups, bump_load_generation
+
+
+def load_staging_tables(cur, conn, filepath, copy_query):
+    """ Calls `COPY` in Postgres to ingest the JSON files into a staging table.
+
+    Each new or changed file (see `pending_files`) is streamed to the server
+    line by line, one `COPY` per file, decompressing compressed files and
+    archives on the way (see `inputs.InputStream`), and recorded in
+    `load_ledger`. A changed log file replaces the songplays of its earlier
+    version (see `etl.begin_file`), its staged rows carry the new ledger
+    entry. A file that fails to load is rolled back to its savepoint and
+    skipped. Nothing is committed, so the ledger entries only persist
+    together with the inserts of `insert_tables`.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        conn (psycopg2 connection): connection to database
+        filepath (str): root of the song or log data tree
+        copy_query (str): `COPY` into the `raw_songs` or `raw_events` table
+    Returns:
+        tuple: (filepath, reason) of the files that failed, and the number
+            of files reloaded
+    """
+    all_files = list(iter_json_files(filepath))
+
+    pending = pending_files(cur, conn, all_files)
+    print('{} files found in {}, {} already loaded'.format(len(all_files), \
+          filepath, len(all_files) - len(pending)))
+
+    skipped = []
+    reloaded = 0
+    for datafile, fingerprint in pending:
+        cur.execute(file_savepoint)
+        try:
+            previous = begin_file(cur, datafile, fingerprint)
+            with InputStream(datafile) as f:
+                cur.copy_expert(copy_query, f)
+        except (psycopg2.DataError,) + INPUT_ERRORS as error:
+            cur.execute(file_savepoint_rollback)
+            skipped.append((datafile, '{}: {}'.format(type(error).__name__, \
+                                                     error)))
+            continue
+        cur.execute(file_savepoint_release)
+        reloaded += previous
+
+    if skipped:
+        print('{} files skipped:'.format(len(skipped)))
+        for datafile, reason in skipped:
+            print('    {}: {}'.format(datafile, reason))
+
+    return skipped, reloaded
+
+
+def insert_tables(cur, conn, queries, generations, params=None):
+    """ Extracts data from staging tables and inserts it into star schema.
+
+    The function runs SQL queries defined in `sql_queries` using combination
+    `INSERT` ... `SELECT` statements to read data from staging tables right into
+    the schema tables, then empties the staging tables, advances the load
+    generations of the tables written, and commits.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        conn (psycopg2 connection): connection to database
+        queries (list): `INSERT` ... `SELECT` statements, in order
+        generations (list): load generations of the tables written, see
+            `etl.bump_load_generation`
+        params (dict): query parameters, e.g. the `tolerance` and `fallback`
+            of the song matches
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    num_of_tables = len(queries)
+    for index, query in enumerate(queries):
+        start = time.perf_counter()
+        cur.execute(query, params)
+        print("{} of {}: {} rows in {:.2f}s".format(index+1, num_of_tables, \
+              cur.rowcount, time.perf_counter() - start))
+    cur.execute(raw_tables_truncate)
+    for name in generations:
+        bump_load_generation(cur, name)
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loads the song and log data '
+                                                 'into the sparkifydb database '
+                                                 'with in-database transforms.')
+    parser.add_argument('--data', default='data',
+                        help='directory containing song_data and log_data')
+    parser.add_argument('--match-tolerance', type=float,
+                        default=MATCH_TOLERANCE,
+                        help='largest song duration difference in seconds')
+    parser.add_argument('--no-match-fallback', action='store_true',
+                        help='do not match songs on title and artist alone')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(SPARKIFY_DSN)
+    cur = conn.cursor()
+
+    for query in elt_staging_queries:
+        cur.execute(query)
+    conn.commit()
+
+    # songs are inserted before the log events are matched against them
+    print("loading song staging table:")
+    load_staging_tables(cur, conn, os.path.join(args.data, 'song_data'), \
+                        raw_song_copy)
+    print("loading song and artist tables:")
+    insert_tables(cur, conn, elt_song_queries, ['songs'])
+
+    print("loading log staging table:")
+    skipped, reloaded = load_staging_tables(cur, conn, \
+                                            os.path.join(args.data, \
+                                                         'log_data'), \
+                                            raw_event_copy)
+    print("loading time, user, and songplay tables:")
+    insert_tables(cur, conn, elt_log_queries, ['songplays', 'users'], \
+                  {'tolerance': args.match_tolerance, \
+                   'fallback': not args.no_match_fallback})
+
+    partitions = split_default_partition(cur, conn)
+    if partitions:
+        print('songplays partitions created: {}'.format(', '.join(partitions)))
+    # reloaded files deleted songplays the rollups already counted
+    update_rollups(cur, conn, rebuild=reloaded > 0)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,97 @@ schema defined in `sql_queries.py` and `README.md`.
 """
 
 import os
-import glob
+import io
+import json
+import queue
+import hashlib
+import argparse
+import itertools
+import threading
+import multiprocessing
+from functools import partial
 import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+import numpy as np
 import pandas as pd
+from instrumentation import Metrics
+from create_tables import drop_indexes, create_indexes
+from song_cache import SONG_CACHE, update_cache
+from binary_copy import copy_binary
+from inputs import is_input, iter_input_lines
 from sql_queries import *
 
+# orjson is optional, but parses the JSON lines several times faster
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
-def process_song_file(cur, filepath):
+
+SPARKIFY_DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+# stage timings of the files processed by this process
+metrics = Metrics()
+
+# largest difference in seconds between a song's duration and an event length
+MATCH_TOLERANCE = 1.0
+
+# times a file is loaded again after its upserts deadlocked with another worker
+DEADLOCK_RETRIES = 3
+
+# log event fields used by the time, users, and songplays tables
+LOG_COLUMNS = ['ts', 'userId', 'firstName', 'lastName', 'gender', 'level', \
+               'song', 'artist', 'length', 'sessionId', 'location', 'userAgent']
+
+
+def read_json_lines(filepath):
+    """ Parses a JSON lines file into a list of records.
+
+    Unlike `pandas.read_json` no DataFrame is built, which dominates the cost
+    of reading the small song files.
+
+    Args:
+        filepath (str): filepath of JSON lines file, compressed file, or
+            archive (see `inputs.iter_input_lines`)
+    Returns:
+        list: one `dict` per non-empty line
+    """
+    return [json_loads(line) for line in iter_input_lines(filepath) \
+            if line.strip()]
+
+
+def iter_log_chunks(filepath, chunksize=None):
+    """ Yields the NextSong events of a log file in chunks.
+
+    The file is read line by line, decompressing it on the fly if needed, so
+    at most `chunksize` events are held in memory at a time no matter how
+    large the file is.
+
+    Args:
+        filepath (str): filepath of log data JSON file, compressed file, or
+            archive (see `inputs.iter_input_lines`)
+        chunksize (int): number of events per chunk, or `None` for a single
+            chunk with all events of the file
+    Returns:
+        generator: non-empty lists of event records
+    """
+    records = []
+    for line in iter_input_lines(filepath):
+        if not line.strip():
+            continue
+        record = json_loads(line)
+        if record.get('page') != 'NextSong':
+            continue
+        records.append(record)
+        if chunksize and len(records) >= chunksize:
+            yield records
+            records = []
+    if records:
+        yield records
+
+
+def process_song_file(cur, filepath, cache=None):
     """ Extracts song JSON file based on schema and inserts it into SQL table.
 
     The function extracts applicable data in the song data JSON file located at
@@ -23,24 +107,345 @@ def process_song_file(cur, filepath):
     Args:
         cur (psycopg2 connection cursor): cursor for the database connection
         filepath (str): filepath of song data JSON file
+        cache (song_cache.SongCache): if given, the file's records are taken
+            from the song cache instead of reading the file
+    Returns:
+        int: number of song records loaded
+    """
+    # open song file, or take its records from the song cache
+    with metrics.stage('parse'):
+        if cache is not None:
+            records = cache.records(filepath)
+        else:
+            records = read_json_lines(filepath)
+
+    with metrics.stage('insert'):
+        for record in records:
+            # insert song record
+            song_data = (record['song_id'], record['title'], \
+                         record['artist_id'], record['year'], \
+                         record['duration'])
+            cur.execute(song_table_insert, song_data)
+
+            # insert artist record
+            artist_data = (record['artist_id'], record['artist_name'], \
+                           record['artist_location'], \
+                           record['artist_latitude'], \
+                           record['artist_longitude'])
+            cur.execute(artist_table_insert, artist_data)
+
+    return len(records)
+
+
+def copy_frame(cur, df, query):
+    """ Streams a DataFrame into Postgres with a single `COPY FROM STDIN`.
+
+    The DataFrame is written to an in-memory CSV buffer with missing values
+    marked as `\\N`, which is then handed to the `COPY` statement `query`.
+    The columns of `df` must be in the order listed by `query`.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        df (pandas.DataFrame): records to copy
+        query (str): `COPY ... FROM STDIN` statement from `sql_queries`
     Returns:
         `None`: actions performed, but no return value
     """
-    # open song file
-    df = pd.read_json(filepath, lines=True)
+    buffer = io.StringIO()
+    df.to_csv(buffer, header=False, index=False, na_rep='\\N')
+    buffer.seek(0)
+    cur.copy_expert(query, buffer)
+
+
+class TimeCache:
+    """ Run-wide record of the timestamps already written to the `time` table.
+
+    The epoch milliseconds are kept in a hashed `set`, so each log file only
+    expands and inserts the timestamps no earlier file of the run had, at a
+    cost proportional to the file rather than to everything cached so far.
+    The `ON CONFLICT` clause of the insert still covers rows from past runs.
+
+    A cache with a `parent` also skips the parent's timestamps, but only
+    records its own; a file loaded in chunks uses one and adds it to the run's
+    cache once the whole file succeeded.
+    """
 
-    # insert song record
-    song_data = df[['song_id', 'title', 'artist_id', \
-                    'year', 'duration']].values.tolist()[0]
-    cur.execute(song_table_insert, song_data)
+    def __init__(self, parent=None):
+        self.emitted = set()
+        self.parent = parent
 
-    # insert artist record
-    artist_data = df[['artist_id', 'artist_name', 'artist_location', \
-                      'artist_latitude', 'artist_longitude']].values.tolist()[0]
-    cur.execute(artist_table_insert, artist_data)
+    def new(self, epoch_ms):
+        """ Returns the unique timestamps in `epoch_ms` not yet emitted.
+
+        Args:
+            epoch_ms (numpy.ndarray): timestamps in milliseconds since epoch
+        Returns:
+            `numpy.ndarray`: sorted unique timestamps missing from the cache
+        """
+        values = np.unique(epoch_ms)
+        if self.emitted:
+            values = values[np.fromiter((value not in self.emitted \
+                                         for value in values.tolist()), \
+                                        dtype=bool, count=len(values))]
+        if self.parent is not None:
+            values = self.parent.new(values)
+        return values
+
+    def add(self, epoch_ms):
+        """ Marks the timestamps in `epoch_ms` as emitted.
+
+        Args:
+            epoch_ms (numpy.ndarray): timestamps in milliseconds since epoch
+        Returns:
+            `None`: actions performed, but no return value
+        """
+        self.emitted.update(np.asarray(epoch_ms).tolist())
+
+
+def normalize_names(names):
+    """ Returns case-folded names with surrounding and repeated spaces removed.
+
+    Args:
+        names (pandas.Series): song titles or artist names
+    Returns:
+        `pandas.Series`: normalized names, `NaN` stays `NaN`
+    """
+    return names.str.strip().str.casefold().str.replace(r'\s+', ' ', regex=True)
+
+
+class SongIndex:
+    """ In-memory index matching log events to songs on normalized keys.
+
+    Titles and artist names are compared with `normalize_names`. An event
+    matches the song of the same title and artist whose duration is nearest
+    to its `length`, if within `tolerance` seconds. With `fallback` set, an
+    event without such a song takes the first song of the same title and
+    artist regardless of duration. Of songs with the same title, artist, and
+    duration, the one with the lowest `song_id` is matched; an event exactly
+    between two durations takes the shorter song.
+
+    Events resolve to the surrogate `song_key` and `artist_key`, so the index
+    is the in-memory dictionary encoding of the natural IDs during a load.
+
+    Attributes:
+        songs (pandas.DataFrame): `norm_title`, `norm_artist`, `duration`,
+            `song_key`, and `artist_key`, sorted by `duration`
+        names (pandas.DataFrame): `song_key` and `artist_key` indexed by
+            (`norm_title`, `norm_artist`) for the fallback tier
+        tolerance (float): largest duration difference in seconds
+        fallback (bool): match on title and artist alone as a last resort
+    """
+
+    def __init__(self, songs_df, tolerance=MATCH_TOLERANCE, fallback=True):
+        songs_df = pd.DataFrame({'norm_title': normalize_names(songs_df.title),
+                                 'norm_artist': normalize_names(songs_df.name),
+                                 'duration': songs_df.duration.astype(float),
+                                 'song_id': songs_df.song_id,
+                                 'song_key': songs_df.song_key,
+                                 'artist_key': songs_df.artist_key}) \
+                     .dropna(subset=['norm_title', 'norm_artist']) \
+                     .sort_values('song_id', kind='mergesort') \
+                     .drop(columns='song_id')
+
+        self.names = songs_df.drop_duplicates(['norm_title', 'norm_artist']) \
+                             .set_index(['norm_title', 'norm_artist']) \
+                             [['song_key', 'artist_key']]
+        # merge_asof takes either end of a run of equal durations depending
+        # on the side it comes from, so only the lowest `song_id` is kept
+        self.songs = songs_df.dropna(subset=['duration']) \
+                             .drop_duplicates(['norm_title', 'norm_artist', \
+                                               'duration']) \
+                             .sort_values('duration', kind='mergesort') \
+                             .reset_index(drop=True)
+        self.tolerance = tolerance
+        self.fallback = fallback
+
+    def lookup(self, df):
+        """ Matches log events to songs, nearest duration first.
+
+        Args:
+            df (pandas.DataFrame): log events with `song`, `artist`, and
+                `length`
+        Returns:
+            tuple: `song_key` and `artist_key` aligned to `df` as `Int32`
+                with `NA` for unmatched events, and the number of events
+                matched by duration, matched by title and artist alone, and
+                unmatched
+        """
+        events = pd.DataFrame({'norm_title': normalize_names(df.song),
+                               'norm_artist': normalize_names(df.artist),
+                               'length': df.length.astype(float),
+                               'position': np.arange(len(df))})
+        matches = pd.DataFrame({'song_key': np.nan, 'artist_key': np.nan}, \
+                               index=range(len(df)))
+
+        # nearest duration within the tolerance, per title and artist
+        timed = events.dropna().sort_values('length', kind='mergesort')
+        num_timed = 0
+        if len(timed) and len(self.songs):
+            timed = pd.merge_asof(timed, self.songs, left_on='length', \
+                                  right_on='duration', \
+                                  by=['norm_title', 'norm_artist'], \
+                                  tolerance=self.tolerance, \
+                                  direction='nearest') \
+                       .dropna(subset=['song_key'])
+            matches.loc[timed.position, ['song_key', 'artist_key']] = \
+                timed[['song_key', 'artist_key']].values
+            num_timed = len(timed)
+
+        # title and artist alone for the events still unmatched
+        num_named = 0
+        if self.fallback:
+            unmatched = events[matches.song_key.isna().values] \
+                          .dropna(subset=['norm_title', 'norm_artist'])
+            named = unmatched.join(self.names, \
+                                   on=['norm_title', 'norm_artist']) \
+                             .dropna(subset=['song_key'])
+            matches.loc[named.position, ['song_key', 'artist_key']] = \
+                named[['song_key', 'artist_key']].values
+            num_named = len(named)
+
+        matches = matches.astype('Int32')
+        matches.index = df.index
+        return matches, num_timed, num_named, len(df) - num_timed - num_named
+
+
+def build_song_index(cur, tolerance=MATCH_TOLERANCE, fallback=True):
+    """ Loads every song and artist name into an in-memory `SongIndex`.
+
+    The function runs `song_index_select` once, so songplays can be resolved
+    with `lookup_songs` without a query per event.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        tolerance (float): largest duration difference in seconds
+        fallback (bool): match on title and artist alone as a last resort
+    Returns:
+        SongIndex: index of all songs
+    """
+    cur.execute(song_index_select)
+    songs_df = pd.DataFrame(cur.fetchall(), columns=['title', 'name', \
+                                                     'duration', 'song_id', \
+                                                     'song_key', 'artist_key'])
+    return SongIndex(songs_df, tolerance, fallback)
+
+
+def lookup_songs(df, song_index):
+    """ Resolves the song and artist keys of log events in memory.
+
+    The match counts of each tier are added to `metrics` as `songs_matched`,
+    `songs_matched_by_name`, and `songs_unmatched`.
+
+    Args:
+        df (pandas.DataFrame): log events with `song`, `artist`, and `length`
+        song_index (SongIndex): index built by `build_song_index`
+    Returns:
+        `pandas.DataFrame`: `song_key` and `artist_key` aligned to `df`,
+            with `NA` for events that have no matching song
+    """
+    matches, timed, named, unmatched = song_index.lookup(df)
+    metrics.count('songs_matched', timed)
+    metrics.count('songs_matched_by_name', named)
+    metrics.count('songs_unmatched', unmatched)
+    return matches
 
 
-def process_log_file(cur, filepath):
+def match_rate(counts):
+    """ Returns a one-line summary of the song match counts in `counts`. """
+    timed = counts.get('songs_matched', 0)
+    named = counts.get('songs_matched_by_name', 0)
+    total = timed + named + counts.get('songs_unmatched', 0)
+    return '{:.1%} of {} songplays matched to songs, {} by duration, {} by ' \
+           'title and artist only'.format((timed + named) / total if total \
+                                          else 0, total, timed, named)
+
+
+def bulk_load_log_data(cur, df):
+    """ Loads the songplays of a transformed log file with `COPY`.
+
+    When `song_key` and `artist_key` were resolved by `lookup_songs`, the
+    songplays are sent straight from the column arrays of `df` with a single
+    binary `COPY` (see `binary_copy`). Otherwise the NextSong events are
+    copied into the temporary `log_staging` table and inserted into the
+    `songplays` table with a single set-based `INSERT` ... `SELECT` that
+    matches the songs like a `SongIndex` with the default tolerance.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        df (pandas.DataFrame): NextSong events of a log file
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    if 'song_key' in df:
+        copy_binary(cur, songplay_binary_copy, \
+                    [('timestamp', df.ts), ('int4', df.userId), \
+                     ('text', df.level), ('int4', df.song_key), \
+                     ('int4', df.artist_key), ('int4', df.sessionId), \
+                     ('text', df.location), ('text', df.userAgent)])
+        return
+
+    df = df.assign(song_key=None, artist_key=None)
+
+    staging_df = df[['ts', 'userId', 'level', 'song', 'artist', 'length', \
+                     'song_key', 'artist_key', 'sessionId', 'location', \
+                     'userAgent']]
+
+    cur.execute(log_staging_table_create)
+    cur.execute(log_staging_truncate)
+    copy_frame(cur, staging_df, log_staging_copy)
+    cur.execute(songplay_staging_lookup_insert, \
+                {'tolerance': MATCH_TOLERANCE, 'fallback': True})
+
+
+def bulk_load_time_data(cur, time_df):
+    """ Loads time rows with a binary `COPY` through a staging table.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        time_df (pandas.DataFrame): time rows of new timestamps
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    cur.execute(time_staging_table_create)
+    cur.execute(time_staging_truncate)
+    copy_binary(cur, time_staging_binary_copy, \
+                [('timestamp', time_df.timestamp), ('int4', time_df.hour), \
+                 ('int4', time_df.day), ('int4', time_df.week_of_year), \
+                 ('int4', time_df.month), ('int4', time_df.year), \
+                 ('text', time_df.weekday)])
+    cur.execute(time_staging_insert)
+
+
+def stage_user_events(cur, df):
+    """ Stages the latest user record of each user in a log file.
+
+    The events in `df` are reduced to one row per `userId`, keeping the one
+    with the latest `ts`, and written to `user_events` in one statement.
+    `merge_user_events` then reduces the staged rows of the whole load run
+    the same way and upserts them into `users`.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        df (pandas.DataFrame): NextSong events of a log file
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    user_data = latest_user_events(df).itertuples(index=False, name=None)
+    psycopg2.extras.execute_values(cur, user_event_bulk_insert, user_data, \
+                                   page_size=1000)
+
+
+def latest_user_events(df):
+    """ Returns the `user_events` columns of each user's latest event in `df`.
+    """
+    latest_df = df.sort_values('ts', kind='mergesort') \
+                  .drop_duplicates('userId', keep='last')
+    return latest_df[['userId', 'firstName', 'lastName', 'gender', \
+                      'level', 'ts']]
+
+
+def process_log_file(cur, filepath, song_index=None, bulk=False, \
+                     time_cache=None, chunksize=None):
     """ Extracts log JSON file based on schema and inserts it into SQL table.
 
     The function extracts applicable information from the log event JSON file
@@ -48,101 +453,773 @@ def process_log_file(cur, filepath):
     inserted into the `time`, `users`, and `songplays` tables according to the
     schema in `sql_queries` and `README`.
 
+    Songplays are resolved against `song_index` in memory when it is given,
+    otherwise `song_select` is queried for every event. With `bulk` set, the
+    records are loaded through a staging table with `COPY` instead of one
+    `INSERT` per row (see `bulk_load_log_data`).
+
+    User records are staged in `user_events` together with their timestamp
+    (see `stage_user_events`), and `users` is only updated once per load run
+    by `merge_user_events`. Each user keeps the `level` of their latest event
+    no matter in which order the files were loaded.
+
+    Time records are only expanded and inserted, in a single statement, for
+    timestamps missing from `time_cache`.
+
+    With a `chunksize`, the file is read, transformed, and loaded that many
+    events at a time (see `iter_log_chunks`), so only one chunk of events is
+    held in memory for large files. The file's new timestamps are still kept
+    until its last chunk, since all chunks load in the same transaction.
+
     Args:
         cur (psycopg2 connection cursor): cursor for the database connection
         filepath (str): filepath of song data JSON file
+        song_index (SongIndex): index built by `build_song_index`
+        bulk (bool): load the file with `COPY` and set-based merges
+        time_cache (TimeCache): timestamps already inserted during the run
+        chunksize (int): number of events loaded at a time
     Returns:
-        `None`: actions performed, but no return value
+        int: number of NextSong events loaded
     """
-    # open log file
-    df = pd.read_json(filepath, lines=True, \
-                      convert_dates=['ts'], date_unit='ms')
+    # timestamps of this file, kept apart until all of its chunks loaded
+    file_times = TimeCache(parent=time_cache)
+    file_new_ms = []
+    rows = 0
+
+    chunks = iter_log_chunks(filepath, chunksize)
+    while True:
+        # open log file and filter by NextSong action
+        with metrics.stage('parse'):
+            records = next(chunks, None)
+        if records is None:
+            break
+
+        df, time_df, new_ms = transform_log_records(records, song_index, \
+                                                    file_times)
+
+        with metrics.stage('insert'):
+            if bulk:
+                bulk_load_time_data(cur, time_df)
+            else:
+                psycopg2.extras.execute_values(cur, time_table_bulk_insert, \
+                                               time_df.itertuples( \
+                                                   index=False, name=None), \
+                                               page_size=1000)
+            stage_user_events(cur, df)
 
-    # filter by NextSong action
-    df = df[df.page == 'NextSong']
+        if bulk:
+            with metrics.stage('insert'):
+                bulk_load_log_data(cur, df)
+        else:
+            insert_songplay_rows(cur, df, song_index is not None)
+
+        file_times.add(new_ms)
+        file_new_ms.append(new_ms)
+        rows += len(df)
 
-    # convert timestamp column to datetime
-    t = df.ts # already converted on load
+    if time_cache is not None and file_new_ms:
+        time_cache.add(np.concatenate(file_new_ms))
 
-    # insert time data records
-    time_data = (t, t.dt.hour, t.dt.day, t.dt.weekofyear, \
-                 t.dt.month, t.dt.year, t.dt.weekday_name)
-    column_labels = ('timestamp', 'hour', 'day', 'week_of_year', \
-                     'month', 'year', 'weekday')
-    time_df = pd.DataFrame({label:column for column, label in \
-                            zip(time_data, column_labels)})
+    return rows
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
 
-    # load user table
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+def transform_log_file(filepath, song_index=None, time_cache=None):
+    """ Reads a log file and prepares its rows without touching the database.
 
-    # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    Args:
+        filepath (str): filepath of log data JSON file
+        song_index (SongIndex): index built by `build_song_index`; when
+            given, `song_key` and `artist_key` are joined to the events
+        time_cache (TimeCache): timestamps already inserted during the run
+    Returns:
+        tuple: as returned by `transform_log_records` for all NextSong events
+            of the file
+    """
+    # open log file and filter by NextSong action
+    with metrics.stage('parse'):
+        records = [record for record in read_json_lines(filepath) \
+                   if record.get('page') == 'NextSong']
 
+    return transform_log_records(records, song_index, time_cache)
+
+
+def transform_log_records(records, song_index=None, time_cache=None):
+    """ Prepares the rows of NextSong events without touching the database.
+
+    Args:
+        records (list): NextSong event records of a log file
+        song_index (SongIndex): index built by `build_song_index`; when
+            given, `song_key` and `artist_key` are joined to the events
+        time_cache (TimeCache): timestamps already inserted during the run
+    Returns:
+        tuple: the NextSong events, the `time` rows of their new timestamps,
+            and those timestamps in epoch milliseconds, to be passed to
+            `TimeCache.add` once the rows are inserted
+    """
+    with metrics.stage('transform'):
+        df = pd.DataFrame.from_records(records, columns=LOG_COLUMNS)
+        df['userId'] = df.userId.astype(int)
+
+        # convert timestamp column to datetime
+        epoch_ms = df.ts.to_numpy(dtype=np.int64)
+        df['ts'] = pd.to_datetime(df.ts, unit='ms')
+
+        # expand only timestamps not yet inserted during this run
+        if time_cache is not None:
+            new_ms = time_cache.new(epoch_ms)
+        else:
+            new_ms = np.unique(epoch_ms)
+        t = pd.Series(pd.to_datetime(new_ms, unit='ms'))
+
+        # insert time data records
+        time_data = (t, t.dt.hour, t.dt.day, \
+                     t.dt.isocalendar().week.astype(int), \
+                     t.dt.month, t.dt.year, t.dt.day_name())
+        column_labels = ('timestamp', 'hour', 'day', 'week_of_year', \
+                         'month', 'year', 'weekday')
+        time_df = pd.DataFrame({label:column for column, label in \
+                                zip(time_data, column_labels)})
+
+    # get songid and artistid of all events from the in-memory index
+    if song_index is not None:
+        with metrics.stage('lookup'):
+            df = df.join(lookup_songs(df, song_index))
+
+    return df, time_df, new_ms
+
+
+def insert_songplay_rows(cur, df, resolved):
+    """ Inserts the songplays of a log file one row at a time.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        df (pandas.DataFrame): NextSong events of a log file
+        resolved (bool): `df` holds `song_key` and `artist_key` from
+            `lookup_songs`, otherwise `song_select` is queried per event
+    Returns:
+        `None`: actions performed, but no return value
+    """
     # insert songplay records
     for index, row in df.iterrows():
 
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-
-        if results:
-            songid, artistid = results
+        if resolved:
+            songid, artistid = (None if pd.isna(key) else int(key) \
+                                for key in (row.song_key, row.artist_key))
         else:
-            songid, artistid = None, None
+            # get songid and artistid from song and artist tables
+            with metrics.stage('lookup'):
+                cur.execute(song_select, (row.song, row.artist, row.length))
+                results = cur.fetchone()
+
+            if results:
+                songid, artistid = results
+            else:
+                songid, artistid = None, None
 
         # insert songplay record
         songplay_data = (row.ts, row.userId, row.level, songid, artistid, \
                          row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+        with metrics.stage('insert'):
+            cur.execute(songplay_table_insert, songplay_data)
+
 
+def merge_user_events(cur, conn):
+    """ Merges the staged user events into the `users` table.
 
-def process_data(cur, conn, filepath, func):
+    Each user's latest event in `user_events` decides their `level`, written
+    with a single upsert that deletes the events it merges, so events staged
+    by a concurrent load are kept for the next merge. Events left behind by
+    an interrupted run are merged by the next one.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        conn (psycopg2 connection): connection to database
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    cur.execute(user_event_merge)
+    bump_load_generation(cur, 'users')
+    conn.commit()
+
+
+def month_partition(month):
+    """ Returns the name and bounds of the `songplays` partition of a month.
+
+    Args:
+        month (str): first day of the month, as YYYY-MM-01
+    Returns:
+        dict: partition `name`, and inclusive `start` and exclusive `end`
+            dates as YYYY-MM-DD
+    """
+    year, month_number = int(month[:4]), int(month[5:7])
+    next_year, next_month = divmod(year * 12 + month_number, 12)
+    return {'name': 'songplays_{:04d}_{:02d}'.format(year, month_number),
+            'start': '{:04d}-{:02d}-01'.format(year, month_number),
+            'end': '{:04d}-{:02d}-01'.format(next_year, next_month + 1)}
+
+
+def split_default_partition(cur, conn):
+    """ Creates the monthly `songplays` partitions of newly arrived months.
+
+    Log events of months without a partition land in `songplays_default`.
+    For each such month a partition is created and its rows are moved into
+    it, one transaction per month, so the default partition is empty again
+    and time-bounded queries can prune to the months they touch. A month
+    whose detached partition still has the partition's name fails with
+    `psycopg2.errors.DuplicateTable` instead of being left in the default
+    partition; rename or drop the detached table first.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        conn (psycopg2 connection): connection to database
+    Returns:
+        list: names of the partitions created
+    """
+    cur.execute(songplay_default_months)
+    months = [month for month, in cur.fetchall()]
+
+    created = []
+    for month in months:
+        partition = month_partition(month)
+        cur.execute(songplay_partition_lock)
+        cur.execute(songplay_month_set_aside, partition)
+        cur.execute(songplay_partition_attached, partition)
+        attached, = cur.fetchone()
+        if not attached:
+            cur.execute(songplay_partition_create.format(**partition))
+        cur.execute(songplay_month_restore)
+        conn.commit()
+        if not attached:
+            created.append(partition['name'])
+
+    return created
+
+
+def update_rollups(cur, conn, rebuild=False):
+    """ Adds the songplays inserted since the last update to the rollups.
+
+    The `rollup_watermark` table holds the highest `songplay_id` counted so
+    far. Songplays above it are aggregated into `hourly_plays` and
+    `daily_user_plays` and added to the existing counts, then the watermark
+    is moved, all in one transaction. Run it once no other load is writing
+    songplays, so no lower `songplay_id` can still be committed afterwards.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        conn (psycopg2 connection): connection to database
+        rebuild (bool): empty the rollups first and recount all songplays,
+            e.g. after a month was detached or reloaded
+    Returns:
+        int: number of songplay IDs the rollups advanced by
+    """
+    if rebuild:
+        cur.execute(rollup_reset)
+
+    cur.execute(rollup_watermark_select)
+    low = cur.fetchone()[0]
+    cur.execute(songplay_max_id_select)
+    high = cur.fetchone()[0]
+
+    if high > low:
+        cur.execute(hourly_plays_update, (low, high))
+        cur.execute(daily_user_plays_update, (low, high))
+        cur.execute(rollup_watermark_update, (high,))
+    if rebuild or high > low:
+        bump_load_generation(cur, 'rollups')
+    conn.commit()
+
+    return max(high - low, 0)
+
+
+def bump_load_generation(cur, name):
+    """ Advances the load generation `name` in the current transaction.
+
+    Caches of query results (see `analytics.py`) drop the results that read
+    tables of a generation once it changed. Listeners of `sparkify_load` are
+    notified when the transaction commits.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        name (str): generation of the changed tables, see `load_generation`
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    cur.execute(load_generation_bump, (name,))
+
+
+def file_fingerprint(filepath):
+    """ Returns the size, modification time, and SHA-256 digest of a file.
+
+    Compressed files and archives are hashed as stored, without decompressing.
+
+    Args:
+        filepath (str): filepath of JSON file
+    Returns:
+        tuple: (size, mtime, content_hash) as stored in `load_ledger`
+    """
+    stat = os.stat(filepath)
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return stat.st_size, stat.st_mtime, digest.hexdigest()
+
+
+def iter_json_files(filepath):
+    """ Yields the absolute filepaths of the JSON files under `filepath`.
+
+    The tree is walked depth first with `os.scandir`, listing every directory
+    once, and files are yielded as soon as their directory is read. Compressed
+    JSON files and tar archives are yielded too, see `inputs.is_input`.
+
+    Args:
+        filepath (str): filepath of directory to scan recursively
+    Returns:
+        generator: absolute filepaths of JSON files
+    """
+    directories = [os.path.abspath(filepath)]
+    while directories:
+        subdirectories = []
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif is_input(entry.name) and entry.is_file():
+                    yield entry.path
+        directories.extend(reversed(subdirectories))
+
+
+def discover_files(filepath, maxsize=1000):
+    """ Yields the JSON files under `filepath` while the tree is being listed.
+
+    A background thread runs `iter_json_files` and hands the filepaths over
+    through a bounded queue, so the first file can be processed before the
+    listing is complete, and the listing runs at most `maxsize` files ahead.
+
+    Args:
+        filepath (str): filepath of directory to scan recursively
+        maxsize (int): number of listed files waiting to be processed
+    Returns:
+        generator: absolute filepaths of JSON files
+    """
+    files = queue.Queue(maxsize)
+    done = object()
+
+    def produce():
+        try:
+            for datafile in iter_json_files(filepath):
+                files.put(datafile)
+        except OSError as error:
+            files.put(error)
+        files.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    for item in iter(files.get, done):
+        if isinstance(item, OSError):
+            raise item
+        yield item
+
+
+def pending_files(cur, conn, all_files, fingerprints=None):
+    """ Compares files against the `load_ledger` and keeps new or changed ones.
+
+    Returns the files of `iter_pending_files` as a list and commits the
+    refreshed ledger entries.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        conn (psycopg2 connection): connection to database
+        all_files (list): absolute filepaths of JSON files
+        fingerprints (dict): known fingerprints of `all_files`, e.g. from
+            `SongCache.fingerprints`, used instead of reading the files
+    Returns:
+        list: (filepath, fingerprint) of each file that needs to be loaded,
+            with the fingerprint from `file_fingerprint`
+    """
+    pending = list(iter_pending_files(cur, all_files, fingerprints))
+    conn.commit()
+    return pending
+
+
+def iter_pending_files(cur, all_files, fingerprints=None, counts=None, \
+                       lookup=False):
+    """ Compares files against the `load_ledger` and yields new or changed ones.
+
+    A file whose size and modification time match its ledger entry is skipped
+    without being read. Otherwise its content hash is computed; a file that was
+    only touched gets its ledger entry refreshed and is skipped as well. The
+    refreshes are left for the caller to commit.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        all_files (iterable): absolute filepaths of JSON files
+        fingerprints (dict): known fingerprints of `all_files`, e.g. from
+            `SongCache.fingerprints`, used instead of reading the files
+        counts (dict): if given, its `found` and `loaded` entries are set to
+            the number of files seen and skipped so far
+        lookup (bool): read only the ledger entries of `all_files`, a list,
+            instead of the whole ledger, for a few files of a long history
+    Returns:
+        generator: (filepath, fingerprint) of each file that needs to be
+            loaded, with the fingerprint from `file_fingerprint`
+    """
+    if lookup:
+        cur.execute(load_ledger_files_select, (list(all_files),))
+    else:
+        cur.execute(load_ledger_select)
+    ledger = {row[0]: row[1:] for row in cur.fetchall()}
+
+    if counts is None:
+        counts = {}
+    counts['found'] = counts['loaded'] = 0
+
+    for datafile in all_files:
+        counts['found'] += 1
+        loaded = ledger.get(datafile)
+        if fingerprints is not None:
+            fingerprint = fingerprints[datafile]
+            size_mtime = fingerprint[:2]
+        else:
+            fingerprint = None
+            stat = os.stat(datafile) if loaded else None
+            size_mtime = (stat.st_size, stat.st_mtime) if loaded else None
+        if loaded and size_mtime == tuple(loaded[:2]):
+            counts['loaded'] += 1
+            continue
+
+        fingerprint = fingerprint or file_fingerprint(datafile)
+        if loaded and loaded[2] == fingerprint[2]:
+            cur.execute(load_ledger_insert, (datafile,) + fingerprint)
+            counts['loaded'] += 1
+            continue
+
+        yield datafile, fingerprint
+
+
+def begin_file(cur, datafile, fingerprint):
+    """ Records a file in `load_ledger` and tags the rows it loads next.
+
+    A file that was loaded before is being reloaded because its content
+    changed, so the songplays of its earlier version are deleted first and
+    the reload replaces them instead of adding to them. The songplays
+    inserted afterwards in the transaction get the file's `file_id` (see
+    `load_file_tag`). Runs inside the file's savepoint, so a failed reload
+    keeps the earlier rows.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        datafile (str): absolute filepath of the file about to be loaded
+        fingerprint (tuple): (size, mtime, content_hash) of the file
+    Returns:
+        bool: whether the file was loaded before
+    """
+    cur.execute(load_ledger_file_select, (datafile,))
+    previous = cur.fetchone()
+    if previous:
+        cur.execute(songplay_file_delete, previous)
+
+    cur.execute(load_ledger_insert, (datafile,) + fingerprint)
+    cur.execute(load_file_tag, (str(cur.fetchone()[0]),))
+    return previous is not None
+
+
+def load_batch(cur, conn, batch, func, batch_rows=None, generation=None):
+    """ Loads a batch of files, committing once at the end of the batch.
+
+    Every file is loaded and recorded in the `load_ledger` inside its own
+    savepoint, so a file that fails is rolled back on its own and skipped
+    while the rest of the batch is kept. A changed file replaces the rows of
+    its earlier version (see `begin_file`) and is counted in `metrics` as
+    `files_reloaded`. Workers upserting the same dimension rows in different
+    orders can deadlock; the file that Postgres aborts is rolled back to its
+    savepoint and loaded again, up to `DEADLOCK_RETRIES` times. With
+    `batch_rows` set, the batch is also committed whenever that many rows
+    were loaded since the last commit. Every file and commit is timed in
+    `metrics`. A commit that includes a loaded file also advances the load
+    `generation`.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        conn (psycopg2 connection): connection to database
+        batch (list): (filepath, fingerprint) of each file to load
+        func (function): function object called on each file, returning the
+            number of rows it loaded
+        batch_rows (int): number of rows after which to commit early
+        generation (str): load generation of the tables `func` writes to
+    Returns:
+        list: (filepath, error message) of each skipped file
+    """
+    skipped = []
+    rows = 0
+    loaded = 0
+    for datafile, fingerprint in batch:
+        metrics.start_file(datafile)
+        cur.execute(file_savepoint)
+        try:
+            for attempt in range(DEADLOCK_RETRIES + 1):
+                try:
+                    with metrics.stage('insert'):
+                        reloaded = begin_file(cur, datafile, fingerprint)
+                    file_rows = func(cur, datafile) or 0
+                    break
+                except psycopg2.errors.DeadlockDetected:
+                    if attempt == DEADLOCK_RETRIES:
+                        raise
+                    cur.execute(file_savepoint_rollback)
+                    metrics.count('deadlock_retries', 1)
+        except Exception as error:
+            cur.execute(file_savepoint_rollback)
+            error = '{}: {}'.format(type(error).__name__, error)
+            skipped.append((datafile, error))
+            metrics.end_file(0, error)
+            continue
+        cur.execute(file_savepoint_release)
+        if reloaded:
+            metrics.count('files_reloaded', 1)
+        metrics.end_file(file_rows)
+
+        rows += file_rows
+        loaded += 1
+        if batch_rows and rows >= batch_rows:
+            with metrics.stage('commit'):
+                if generation:
+                    bump_load_generation(cur, generation)
+                conn.commit()
+            rows = loaded = 0
+
+    with metrics.stage('commit'):
+        if generation and loaded:
+            bump_load_generation(cur, generation)
+        conn.commit()
+    return skipped
+
+
+def init_worker(func, batch_rows, generation):
+    """ Opens the database connection of a `process_data` pool worker.
+
+    Args:
+        func (function): function object called on each file by the worker
+        batch_rows (int): number of rows after which to commit early
+        generation (str): load generation of the tables `func` writes to
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    global worker_conn, worker_cur, worker_func, worker_batch_rows, \
+           worker_generation
+    worker_conn = psycopg2.connect(SPARKIFY_DSN)
+    worker_cur = worker_conn.cursor()
+    worker_func = func
+    worker_batch_rows = batch_rows
+    worker_generation = generation
+
+    # records are handed to the parent process instead of its sink
+    metrics.sink = None
+    metrics.reset()
+
+
+def process_batch_worker(batch):
+    """ Loads and commits a batch of files inside a pool worker.
+
+    Args:
+        batch (list): (filepath, fingerprint) of each file to load
+    Returns:
+        tuple: number of files in `batch`, the skipped files as returned by
+            `load_batch`, and the `metrics` records of the batch
+    """
+    skipped = load_batch(worker_cur, worker_conn, batch, worker_func, \
+                         worker_batch_rows, worker_generation)
+    return len(batch), skipped, metrics.drain()
+
+
+def process_data(cur, conn, filepath, func, workers=1, batch_files=1, \
+                 batch_rows=None, cache=None, generation=None):
     """ Wrapper that scans for JSON files and passes them to a function.
 
     Function recursively scans directory trees with root directory of
     `filepath` for any JSON files. The passed function `func` is then called on
-    each JSON file.
+    each JSON file that is new or changed since it was last recorded in the
+    `load_ledger` table. Each file is recorded in the ledger in the same
+    transaction as its data. Files are processed while the tree is still being
+    listed (see `discover_files`).
+
+    Files are committed in batches of `batch_files` files, or earlier once
+    `batch_rows` rows were loaded. A file that fails is rolled back to its
+    savepoint and skipped without affecting the rest of its batch (see
+    `load_batch`); the skipped files are listed at the end.
+
+    With more than one worker the files are spread across a process pool in
+    which every worker holds its own database connection. Files then load in
+    no particular order, so `func` must not depend on it.
+
+    With a `cache` of the tree, the files and their fingerprints are taken
+    from its manifest instead of scanning the tree; `func` should then read
+    the records from the same cache.
 
     Args:
         cur (psycopg2 connection cursor): cursor for the database connection
         conn (psycopg2 connection): connection to database
         filepath (str): filepath of directory to scan recursively
-        func (function): function object called on JSON files in `filepath`
+        func (function): function object called on JSON files in `filepath`,
+            returning the number of rows it loaded
+        workers (int): number of worker processes
+        batch_files (int): number of files per commit
+        batch_rows (int): number of rows after which to commit early
+        cache (SongCache): up-to-date cache of the tree at `filepath`
+        generation (str): load generation advanced by every commit of loaded
+            files, see `bump_load_generation`
     Returns:
-        `None`: actions performed, but no return value
+        list: (filepath, error message) of each skipped file
     """
-    # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+    # stream files matching extension from directory, or take them from the
+    # cache
+    if cache is not None:
+        fingerprints = cache.fingerprints()
+        all_files = sorted(fingerprints)
+    else:
+        fingerprints = None
+        all_files = discover_files(filepath)
 
-    # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    # skip files already loaded by a previous run
+    counts = {}
+    tasks = iter_pending_files(cur, all_files, fingerprints, counts)
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+    # group files into commit batches as they arrive
+    batches = iter(lambda: list(itertools.islice(tasks, batch_files)), [])
+
+    # spread batches across worker processes or iterate over them in order
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_worker, \
+                                    initargs=(func, batch_rows, generation))
+        results = pool.imap_unordered(process_batch_worker, batches)
+    else:
+        pool = None
+        results = ((len(batch), load_batch(cur, conn, batch, func, \
+                                           batch_rows, generation), []) \
+                   for batch in batches)
+
+    processed = 0
+    skipped = []
+    try:
+        for batch_size, batch_skipped, batch_records in results:
+            processed += batch_size
+            skipped.extend(batch_skipped)
+            for record in batch_records:
+                metrics.record(record)
+            print('{} files processed.'.format(processed))
+    finally:
+        # all batches are done, or one failed and the rest are abandoned;
+        # either way the workers exit and close their connections
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    # commit the ledger entries refreshed for touched files
+    conn.commit()
+    print('{} files found in {}, {} already loaded'.format(counts['found'], \
+          filepath, counts['loaded']))
+
+    # summarize files that were rolled back
+    if skipped:
+        print('{} files skipped:'.format(len(skipped)))
+        for datafile, error in skipped:
+            print('    {}: {}'.format(datafile, error))
+
+    return skipped
 
 
 def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb \
-                             user=student password=student")
+    parser = argparse.ArgumentParser(description='Loads the song and log data '
+                                                 'into the sparkifydb database.')
+    parser.add_argument('--bulk', action='store_true',
+                        help='load log files with COPY and set-based merges')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes loading files in parallel')
+    parser.add_argument('--batch-files', type=int, default=1,
+                        help='number of files committed together')
+    parser.add_argument('--batch-rows', type=int,
+                        help='also commit once this many rows were loaded')
+    parser.add_argument('--metrics',
+                        help='JSON lines file for per-file stage timings')
+    parser.add_argument('--defer-indexes', action='store_true',
+                        help='drop the lookup indexes during the load and '
+                             'rebuild them afterwards')
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help='recount the rollup tables from all songplays')
+    parser.add_argument('--song-cache', default=SONG_CACHE,
+                        help='Parquet cache of song_data, used if it exists')
+    parser.add_argument('--chunksize', type=int,
+                        help='number of log events loaded at a time')
+    parser.add_argument('--match-tolerance', type=float,
+                        default=MATCH_TOLERANCE,
+                        help='largest song duration difference in seconds')
+    parser.add_argument('--no-match-fallback', action='store_true',
+                        help='do not match songs on title and artist alone')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.sink = open(args.metrics, 'w')
+
+    conn = psycopg2.connect(SPARKIFY_DSN)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    # a backfill should not maintain the lookup indexes on every insert
+    if args.defer_indexes:
+        drop_indexes(cur, conn)
+
+    # songs are read from their Parquet cache once it was built, refreshed
+    # with the files changed since
+    if os.path.exists(args.song_cache):
+        with metrics.stage('cache'):
+            song_cache = update_cache('data/song_data', args.song_cache)
+    else:
+        song_cache = None
+
+    process_data(cur, conn, filepath='data/song_data', \
+                 func=partial(process_song_file, cache=song_cache), \
+                 workers=args.workers, batch_files=args.batch_files, \
+                 batch_rows=args.batch_rows, cache=song_cache, \
+                 generation='songs')
+
+    # songs are indexed once, after they are loaded and before the log events
+    with metrics.stage('index'):
+        song_index = build_song_index(cur, args.match_tolerance, \
+                                      not args.no_match_fallback)
+
+    process_data(cur, conn, filepath='data/log_data', \
+                 func=partial(process_log_file, song_index=song_index, \
+                              bulk=args.bulk, time_cache=TimeCache(), \
+                              chunksize=args.chunksize), \
+                 workers=args.workers, batch_files=args.batch_files, \
+                 batch_rows=args.batch_rows, generation='songplays')
+
+    # users are consolidated once, after all log files are loaded
+    with metrics.stage('merge'):
+        merge_user_events(cur, conn)
+
+    # new months get their partitions once, without moving rows per file
+    with metrics.stage('partition'):
+        partitions = split_default_partition(cur, conn)
+    if partitions:
+        print('songplays partitions created: {}'.format(', '.join(partitions)))
+
+    # the dashboards read rollups, updated with this run's songplays only;
+    # reloaded files deleted songplays that were already counted
+    with metrics.stage('rollup'):
+        update_rollups(cur, conn, rebuild=args.rebuild_rollups or \
+                       bool(metrics.counts.get('files_reloaded')))
+
+    if args.defer_indexes:
+        with metrics.stage('reindex'):
+            create_indexes(cur, conn)
 
     conn.close()
 
+    summary = metrics.report()
+    print(match_rate(summary['counts']))
+    if metrics.sink:
+        metrics.sink.close()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,297 @@
+""" asyncio ETL pipeline
+
+Loads the same `data/song_data` and `data/log_data` trees into the same tables
+as `etl.py`, but writes them through `asyncpg` so the network round trips to a
+remote Postgres overlap with reading and parsing the next files.
+
+A single parser thread reads and transforms files with the functions of
+`etl.py` and hands the prepared rows to a bounded queue. A fixed number of
+writer tasks, one pooled connection each, take files from the queue and load
+each one in its own transaction, sending its statements as pipelined batches
+with `executemany` and `COPY`. The queue bound keeps the parser from running
+ahead of the writers. The per-run steps before and after the load (ledger,
+song index, user merge, partitions, rollups) run once on psycopg2 as in
+`etl.py`.
+"""
+
+import asyncio
+import argparse
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+import asyncpg
+import psycopg2
+import psycopg2.extensions
+from sql_queries import song_table_insert, artist_table_insert, \
+                        time_table_insert, load_ledger_insert, \
+                        load_generation_bump, load_ledger_file_select, \
+                        songplay_file_delete, load_file_tag
+from etl import SPARKIFY_DSN, TimeCache, metrics, read_json_lines, \
+                transform_log_file, latest_user_events, build_song_index, \
+                iter_json_files, pending_files, merge_user_events, \
+                split_default_partition, update_rollups, match_rate
+
+
+# columns of the plain inserts, which are sent with COPY
+USER_EVENT_COLUMNS = ['user_id', 'first_name', 'last_name', 'gender', \
+                      'level', 'start_time']
+SONGPLAY_COLUMNS = ['start_time', 'user_id', 'level', 'song_key', \
+                    'artist_key', 'session_id', 'location', 'user_agent']
+
+
+def to_asyncpg(query):
+    """ Returns `query` with its `%s` placeholders numbered as `$1`, `$2`, ...
+    """
+    parts = query.split('%s')
+    return parts[0] + ''.join('${}{}'.format(n, part) \
+                              for n, part in enumerate(parts[1:], 1))
+
+
+song_insert = to_asyncpg(song_table_insert)
+artist_insert = to_asyncpg(artist_table_insert)
+time_insert = to_asyncpg(time_table_insert)
+ledger_insert = to_asyncpg(load_ledger_insert)
+ledger_file_select = to_asyncpg(load_ledger_file_select)
+file_delete = to_asyncpg(songplay_file_delete)
+file_tag = to_asyncpg(load_file_tag)
+generation_bump = to_asyncpg(load_generation_bump)
+
+
+def connect_options(dsn):
+    """ Returns the `asyncpg` connection arguments of a libpq `dsn` string. """
+    options = psycopg2.extensions.parse_dsn(dsn)
+    if 'dbname' in options:
+        options['database'] = options.pop('dbname')
+    return options
+
+
+def to_decimal(value):
+    """ Returns a JSON number as the `Decimal` of its shortest repr.
+
+    `asyncpg` encodes a float for a `NUMERIC` column as its exact binary
+    value, e.g. 337.68444 as 337.6844399999999950..., while psycopg2 sends its
+    repr. Converting first stores the same value as `etl.py`, so exact
+    duration matches keep working.
+    """
+    return None if value is None else Decimal(repr(value))
+
+
+def prepare_song_file(filepath):
+    """ Returns the song and artist rows of a song file. """
+    songs, artists = [], []
+    for record in read_json_lines(filepath):
+        songs.append((record['song_id'], record['title'], \
+                      record['artist_id'], record['year'], \
+                      to_decimal(record['duration'])))
+        artists.append((record['artist_id'], record['artist_name'], \
+                        record['artist_location'], \
+                        to_decimal(record['artist_latitude']), \
+                        to_decimal(record['artist_longitude'])))
+    return {'songs': songs, 'artists': artists}
+
+
+def prepare_log_file(filepath, song_index, time_cache):
+    """ Returns the time, user event, and songplay rows of a log file.
+
+    Rows are converted to Python objects, since `asyncpg` does not encode
+    numpy scalars or `NA`.
+
+    Args:
+        filepath (str): filepath of log data JSON file
+        song_index (SongIndex): index built by `build_song_index`
+        time_cache (TimeCache): timestamps already inserted during the run
+    Returns:
+        dict: rows per table, and the new timestamps for `TimeCache.add`
+    """
+    df, time_df, new_ms = transform_log_file(filepath, song_index, time_cache)
+    users_df = latest_user_events(df)
+    df = df.rename(columns={'userId': 'user_id', 'sessionId': 'session_id', \
+                            'userAgent': 'user_agent', 'ts': 'start_time'})
+    songplays_df = df[SONGPLAY_COLUMNS]
+    songplays_df = songplays_df.astype(object) \
+                               .where(songplays_df.notna(), None)
+
+    return {'time': [tuple(row) for row in \
+                     time_df.astype(object).itertuples(index=False)],
+            'user_events': [tuple(row) for row in \
+                            users_df.astype(object).itertuples(index=False)],
+            'songplays': [tuple(row) for row in \
+                          songplays_df.itertuples(index=False)],
+            'new_ms': new_ms}
+
+
+async def load_song_rows(conn, rows):
+    """ Inserts the prepared rows of a song file, returns the songs loaded. """
+    await conn.executemany(song_insert, rows['songs'])
+    await conn.executemany(artist_insert, rows['artists'])
+    return len(rows['songs'])
+
+
+async def load_log_rows(conn, rows):
+    """ Inserts the prepared rows of a log file, returns the events loaded. """
+    await conn.executemany(time_insert, rows['time'])
+    await conn.copy_records_to_table('user_events', \
+                                     records=rows['user_events'], \
+                                     columns=USER_EVENT_COLUMNS)
+    await conn.copy_records_to_table('songplays', records=rows['songplays'], \
+                                     columns=SONGPLAY_COLUMNS)
+    return len(rows['songplays'])
+
+
+async def writer(pool, queue, load, generation, skipped, time_cache):
+    """ Loads prepared files from `queue` until it yields `None`.
+
+    Each file, its `load_ledger` entry, and the advance of its load
+    generation are written in one transaction. A changed file replaces the
+    songplays of its earlier version as in `etl.begin_file`. A failing file
+    is rolled back and added to `skipped`.
+
+    Args:
+        pool (asyncpg.Pool): connection pool
+        queue (asyncio.Queue): (filepath, fingerprint, rows) of parsed files
+        load (function): coroutine function inserting the rows of one file
+        generation (str): load generation of the tables `load` writes to
+        skipped (list): (filepath, reason) of the files that failed
+        time_cache (TimeCache): timestamps inserted during the run, or `None`
+    Returns:
+        int: number of rows loaded
+    """
+    rows_loaded = 0
+    async with pool.acquire() as conn:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return rows_loaded
+
+            datafile, fingerprint, rows = item
+            try:
+                async with conn.transaction():
+                    previous = await conn.fetchval(ledger_file_select, \
+                                                   datafile)
+                    if previous is not None:
+                        await conn.execute(file_delete, previous)
+                    file_id = await conn.fetchval(ledger_insert, datafile, \
+                                                  *fingerprint)
+                    await conn.execute(file_tag, str(file_id))
+                    rows_loaded += await load(conn, rows)
+                    await conn.execute(generation_bump, generation)
+            except Exception as error:
+                skipped.append((datafile, '{}: {}'.format( \
+                                type(error).__name__, error)))
+                continue
+
+            if previous is not None:
+                metrics.count('files_reloaded', 1)
+            if time_cache is not None:
+                time_cache.add(rows['new_ms'])
+
+
+async def process_data_async(pool, cur, conn, filepath, prepare, load, \
+                             generation, connections, queue_size, \
+                             time_cache=None):
+    """ Loads the pending files of a tree with pipelined writers.
+
+    Args:
+        pool (asyncpg.Pool): connection pool with at least `connections`
+        cur (psycopg2 connection cursor): cursor used for the ledger lookup
+        conn (psycopg2 connection): connection used for the ledger lookup
+        filepath (str): root of the song or log data tree
+        prepare (function): function object returning the rows of one file
+        load (function): coroutine function inserting the rows of one file
+        generation (str): load generation of the tables `load` writes to
+        connections (int): number of files loaded concurrently
+        queue_size (int): number of parsed files waiting for a writer
+        time_cache (TimeCache): timestamps inserted during the run, or `None`
+    Returns:
+        list: (filepath, reason) of the files that failed
+    """
+    all_files = list(iter_json_files(filepath))
+
+    pending = pending_files(cur, conn, all_files)
+    print('{} files found in {}, {} already loaded'.format( \
+          len(all_files), filepath, len(all_files) - len(pending)))
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    skipped = []
+    writers = [asyncio.ensure_future(writer(pool, queue, load, generation, \
+                                            skipped, time_cache)) \
+               for _ in range(connections)]
+
+    # one parser thread, so the time cache is read in file order
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for i, (datafile, fingerprint) in enumerate(pending, 1):
+            try:
+                rows = await loop.run_in_executor(executor, prepare, datafile)
+            except Exception as error:
+                skipped.append((datafile, '{}: {}'.format( \
+                                type(error).__name__, error)))
+                continue
+            # waits while all writers are busy and the queue is full
+            await queue.put((datafile, fingerprint, rows))
+            if i % 100 == 0:
+                print('{}/{} files parsed.'.format(i, len(pending)))
+
+    for _ in writers:
+        await queue.put(None)
+    rows_loaded = sum(await asyncio.gather(*writers))
+
+    print('{} files processed, {} rows loaded.'.format( \
+          len(pending) - len(skipped), rows_loaded))
+    if skipped:
+        print('{} files skipped:'.format(len(skipped)))
+        for datafile, reason in skipped:
+            print('    {}: {}'.format(datafile, reason))
+
+    return skipped
+
+
+async def run(args):
+    conn = psycopg2.connect(SPARKIFY_DSN)
+    cur = conn.cursor()
+    pool = await asyncpg.create_pool(**connect_options(SPARKIFY_DSN), \
+                                     min_size=args.connections, \
+                                     max_size=args.connections)
+
+    await process_data_async(pool, cur, conn, 'data/song_data', \
+                             prepare_song_file, load_song_rows, 'songs', \
+                             args.connections, args.queue)
+
+    song_index = build_song_index(cur)
+    time_cache = TimeCache()
+    await process_data_async(pool, cur, conn, 'data/log_data', \
+                             lambda datafile: prepare_log_file( \
+                                 datafile, song_index, time_cache), \
+                             load_log_rows, 'songplays', args.connections, \
+                             args.queue, time_cache)
+
+    await pool.close()
+
+    merge_user_events(cur, conn)
+    partitions = split_default_partition(cur, conn)
+    if partitions:
+        print('songplays partitions created: {}'.format(', '.join(partitions)))
+    # reloaded files deleted songplays the rollups already counted
+    update_rollups(cur, conn, \
+                   rebuild=bool(metrics.counts.get('files_reloaded')))
+
+    conn.close()
+
+    summary = metrics.report()
+    print(match_rate(summary['counts']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loads the song and log data '
+                                                 'into the sparkifydb database '
+                                                 'with asyncio.')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='number of files written concurrently')
+    parser.add_argument('--queue', type=int, default=8,
+                        help='number of parsed files waiting for a writer')
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+""" Synthetic Sparkify data generator
+
+Writes song and log JSON trees with the same directory layout and fields as
+the sample in `data/song_data` and `data/log_data`, at a chosen scale. The
+log events play the generated songs, so songplays resolve to song and artist
+IDs like they would on the production data.
+"""
+
+import os
+import json
+import random
+import string
+import argparse
+from datetime import datetime, timedelta
+
+
+WORDS = ['love', 'night', 'heart', 'fire', 'dream', 'rain', 'city', 'river',
+         'gold', 'shadow', 'light', 'blue', 'wild', 'summer', 'road', 'star',
+         'ghost', 'ocean', 'silver', 'home', 'dance', 'storm', 'stone', 'sky']
+FIRST_NAMES = {'F': ['Kaylee', 'Lily', 'Jacqueline', 'Chloe', 'Tegan', 'Ava',
+                     'Aleena', 'Jayden', 'Layla', 'Rylan'],
+               'M': ['Walter', 'Ryan', 'Jacob', 'Lucas', 'Noah', 'Mohammad',
+                     'Kevin', 'Theodore', 'Sean', 'Wyatt']}
+LAST_NAMES = ['Summers', 'Koch', 'Lynch', 'Cruz', 'Levine', 'Chavez', 'Frye',
+              'Smith', 'Harrell', 'Rodriguez', 'Scott', 'Kirby', 'Lowe']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ',
+             'New York-Newark-Jersey City, NY-NJ-PA', 'Chicago, IL',
+             'Atlanta-Sandy Springs-Roswell, GA', 'Lansing-East Lansing, MI',
+             'Portland-South Portland, ME', 'Waterloo-Cedar Falls, IA']
+USER_AGENTS = [
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like '
+    'Gecko) Chrome/35.0.1916.153 Safari/537.36"',
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+    '"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Ubuntu Chromium/36.0.1985.125 Chrome/36.0.1985.125 Safari/537.36"']
+# non-NextSong pages and their relative frequency in the sample logs
+OTHER_PAGES = [('Home', 806), ('Logout', 90), ('Downgrade', 60),
+               ('Settings', 56), ('Help', 47), ('About', 36), ('Upgrade', 21),
+               ('Save Settings', 10), ('Error', 9), ('Submit Upgrade', 8),
+               ('Submit Downgrade', 1)]
+
+
+def random_id(rng, prefix, length=16):
+    """ Returns an ID such as `SOGVQGJ12AB017F169` with the given prefix. """
+    alphabet = string.ascii_uppercase + string.digits
+    return prefix + ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+def random_title(rng):
+    """ Returns a title of one to four capitalized words. """
+    return ' '.join(rng.choice(WORDS).title() \
+                    for _ in range(rng.randint(1, 4)))
+
+
+def generate_songs(rng, output, num_songs, num_artists):
+    """ Writes one single-record JSON file per song into `output/song_data`.
+
+    Files are stored under the first three letters after the `TR` prefix of
+    a random track ID, e.g. `song_data/A/B/C/TRABCKL128F932546F.json`.
+
+    Args:
+        rng (random.Random): random number generator
+        output (str): root directory of the generated data
+        num_songs (int): number of song files to write
+        num_artists (int): number of distinct artists
+    Returns:
+        list: (title, artist name, duration) of every song written
+    """
+    artists = []
+    for _ in range(num_artists):
+        located = rng.random() < 0.4
+        artists.append((random_id(rng, 'AR'), random_title(rng), \
+                        rng.choice(LOCATIONS) if located else '', \
+                        round(rng.uniform(-60, 60), 5) if located else None, \
+                        round(rng.uniform(-150, 150), 5) if located else None))
+
+    songs = []
+    for _ in range(num_songs):
+        artist_id, name, location, latitude, longitude = rng.choice(artists)
+        title = random_title(rng)
+        duration = round(rng.uniform(30, 600), 5)
+        track_id = 'TR' + ''.join(rng.choice(string.ascii_uppercase) \
+                                  for _ in range(3)) + random_id(rng, '', 13)
+        record = {'num_songs': 1,
+                  'artist_id': artist_id,
+                  'artist_latitude': latitude,
+                  'artist_longitude': longitude,
+                  'artist_location': location,
+                  'artist_name': name,
+                  'song_id': random_id(rng, 'SO'),
+                  'title': title,
+                  'duration': duration,
+                  'year': rng.choice([0, rng.randint(1960, 2018)])}
+
+        directory = os.path.join(output, 'song_data', *track_id[2:5])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w') as f:
+            json.dump(record, f)
+
+        songs.append((title, name, duration))
+
+    return songs
+
+
+def generate_users(rng, num_users, start):
+    """ Returns the attributes of `num_users` app users.
+
+    Args:
+        rng (random.Random): random number generator
+        num_users (int): number of users
+        start (datetime): first day of the logs
+    Returns:
+        list: one `dict` of user fields per user
+    """
+    users = []
+    for user_id in range(1, num_users + 1):
+        gender = rng.choice('FM')
+        registration = start - timedelta(days=rng.uniform(1, 365))
+        users.append({'userId': str(user_id),
+                      'firstName': rng.choice(FIRST_NAMES[gender]),
+                      'lastName': rng.choice(LAST_NAMES),
+                      'gender': gender,
+                      'level': rng.choice(['free', 'free', 'paid']),
+                      'location': rng.choice(LOCATIONS),
+                      'userAgent': rng.choice(USER_AGENTS),
+                      'registration': float(int(registration.timestamp()) \
+                                            * 1000)})
+    return users
+
+
+def generate_log_file(rng, filepath, day, events, songs, cum_weights, users):
+    """ Writes one JSON lines file with a day's worth of user sessions.
+
+    Events are sorted by `ts`. Roughly 80% are NextSong actions on songs picked
+    with a long-tailed popularity; the rest are the other pages of the sample
+    logs. A user switches `level` on 'Submit Upgrade' and 'Submit Downgrade'.
+
+    Args:
+        rng (random.Random): random number generator
+        filepath (str): filepath of the log file to write
+        day (datetime): midnight of the day the events happen on
+        events (int): number of events in the file
+        songs (list): (title, artist name, duration) from `generate_songs`
+        cum_weights (list): cumulative popularity weights of `songs`
+        users (list): users from `generate_users`
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    timestamps = sorted(rng.uniform(0, 86400000) for _ in range(events))
+    session_base = int(day.timestamp() // 60)
+    sessions = {}
+    pages, page_weights = zip(*OTHER_PAGES)
+
+    with open(filepath, 'w') as f:
+        for offset in timestamps:
+            user = rng.choice(users)
+            if user['userId'] not in sessions:
+                sessions[user['userId']] = (session_base + rng.randint(0, 999), -1)
+            session_id, item = sessions[user['userId']]
+            item += 1
+            sessions[user['userId']] = (session_id, item)
+
+            if rng.random() < 0.8:
+                title, artist, length = rng.choices(songs, \
+                                                    cum_weights=cum_weights)[0]
+                page, method, status = 'NextSong', 'PUT', 200
+            else:
+                title = artist = length = None
+                page = rng.choices(pages, weights=page_weights)[0]
+                method, status = 'GET', 200
+                if page == 'Submit Upgrade':
+                    user['level'], method, status = 'paid', 'PUT', 307
+                elif page == 'Submit Downgrade':
+                    user['level'], method, status = 'free', 'PUT', 307
+
+            event = {'artist': artist,
+                     'auth': 'Logged In',
+                     'firstName': user['firstName'],
+                     'gender': user['gender'],
+                     'itemInSession': item,
+                     'lastName': user['lastName'],
+                     'length': length,
+                     'level': user['level'],
+                     'location': user['location'],
+                     'method': method,
+                     'page': page,
+                     'registration': user['registration'],
+                     'sessionId': session_id,
+                     'song': title,
+                     'status': status,
+                     'ts': int(day.timestamp() * 1000 + offset),
+                     'userAgent': user['userAgent'],
+                     'userId': user['userId']}
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+
+def generate_logs(rng, output, songs, num_files, events_per_file, num_users, \
+                  start, files_per_day):
+    """ Writes the log event tree into `output/log_data`.
+
+    Files are named like the sample, `log_data/2018/11/2018-11-01-events.json`,
+    one day after another from `start`. With more than one file per day the
+    files of a day are numbered, e.g. `2018-11-01-3-events.json`.
+
+    Args:
+        rng (random.Random): random number generator
+        output (str): root directory of the generated data
+        songs (list): (title, artist name, duration) from `generate_songs`
+        num_files (int): number of log files to write
+        events_per_file (int): number of events per log file
+        num_users (int): number of distinct users
+        start (datetime): first day of the logs
+        files_per_day (int): number of log files per day
+    Returns:
+        `None`: actions performed, but no return value
+    """
+    users = generate_users(rng, num_users, start)
+
+    cum_weights = []
+    total = 0.0
+    for rank in range(len(songs)):
+        total += 1.0 / (rank + 1)
+        cum_weights.append(total)
+
+    for n in range(num_files):
+        day = start + timedelta(days=n // files_per_day)
+        directory = os.path.join(output, 'log_data', \
+                                 day.strftime('%Y'), day.strftime('%m'))
+        os.makedirs(directory, exist_ok=True)
+        if files_per_day > 1:
+            filename = '{}-{}-events.json'.format(day.strftime('%Y-%m-%d'), \
+                                                  n % files_per_day + 1)
+        else:
+            filename = '{}-events.json'.format(day.strftime('%Y-%m-%d'))
+
+        generate_log_file(rng, os.path.join(directory, filename), day, \
+                          events_per_file, songs, cum_weights, users)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates song and log data '
+                                                 'trees at a chosen scale.')
+    parser.add_argument('--output', default='data_generated',
+                        help='directory to write song_data and log_data into')
+    parser.add_argument('--songs', type=int, default=10000,
+                        help='number of song files')
+    parser.add_argument('--artists', type=int,
+                        help='number of artists, default a third of the songs')
+    parser.add_argument('--log-files', type=int, default=30,
+                        help='number of log files')
+    parser.add_argument('--events-per-file', type=int, default=300,
+                        help='number of events per log file')
+    parser.add_argument('--files-per-day', type=int, default=1,
+                        help='number of log files per day')
+    parser.add_argument('--users', type=int, default=100,
+                        help='number of users')
+    parser.add_argument('--start', default='2018-11-01',
+                        help='first day of the logs, as YYYY-MM-DD')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random number generator')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = datetime.strptime(args.start, '%Y-%m-%d')
+    num_artists = args.artists or max(1, args.songs // 3)
+
+    songs = generate_songs(rng, args.output, args.songs, num_artists)
+    print('{} song files written to {}'.format(args.songs, args.output))
+
+    generate_logs(rng, args.output, songs, args.log_files, \
+                  args.events_per_file, args.users, start, args.files_per_day)
+    print('{} log files written to {}'.format(args.log_files, args.output))
+
+
+if __name__ == "__main__":
+    main()
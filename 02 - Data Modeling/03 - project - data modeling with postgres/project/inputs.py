@@ -0,0 +1,108 @@
+""" Input files
+
+Reads the JSON lines of the data trees whether a file is stored plain,
+compressed with gzip (`.json.gz`) or Zstandard (`.json.zst`), or packed with
+the rest of a directory into a tar archive (`.tar`, `.tar.gz`, `.tgz`,
+`.tar.zst`). Files are decompressed as a stream while they are parsed, so a
+compressed input is never written to disk or held in memory as a whole. An
+archive is a single input: its JSON members are read one after the other in
+archive order.
+
+Reading Zstandard input requires `zstandard`.
+"""
+
+import io
+import gzip
+import tarfile
+
+# zstandard is optional, only needed for .zst inputs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+JSON_SUFFIXES = ('.json', '.json.gz', '.json.zst')
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.zst')
+# errors of a truncated or corrupt input, or a missing decompressor
+INPUT_ERRORS = (OSError, EOFError, tarfile.TarError, ImportError) + \
+               ((zstandard.ZstdError,) if zstandard else ())
+
+
+def is_input(name):
+    """ Returns whether a file name is a JSON file or an archive of them. """
+    return name.endswith(JSON_SUFFIXES + ARCHIVE_SUFFIXES) and \
+           not name.startswith('.')
+
+
+def decompress(f, name):
+    """ Returns a stream of the decompressed bytes of `f`.
+
+    Args:
+        f (file object): binary stream of a file as stored
+        name (str): file name, whose suffix gives the compression
+    Returns:
+        file object: binary stream that can be read line by line
+    """
+    if name.endswith(('.gz', '.tgz')):
+        return gzip.GzipFile(fileobj=f)
+    if name.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('zstandard is required to read ' + name)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+    return f
+
+
+def iter_input_lines(filepath):
+    """ Yields the lines of a JSON input as bytes.
+
+    Args:
+        filepath (str): filepath of a JSON file or archive, see `is_input`
+    Returns:
+        generator: lines of the file, or of every JSON member of the archive
+    """
+    with open(filepath, 'rb') as raw:
+        stream = decompress(raw, filepath)
+        if not filepath.endswith(ARCHIVE_SUFFIXES):
+            yield from stream
+            return
+
+        # stream mode reads the members in order without seeking
+        with tarfile.open(fileobj=stream, mode='r|') as archive:
+            for member in archive:
+                name = member.name.rsplit('/', 1)[-1]
+                if member.isfile() and name.endswith(JSON_SUFFIXES) and \
+                   not name.startswith('.'):
+                    yield from decompress(archive.extractfile(member), name)
+
+
+class InputStream(io.RawIOBase):
+    """ Readable stream of the non-empty lines of a JSON input.
+
+    Every line ends with a newline, also the last line of each archive
+    member, so the stream can be sent to Postgres with `COPY` as is.
+    """
+
+    def __init__(self, filepath):
+        self.lines = iter_input_lines(filepath)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            line = next(self.lines, None)
+            if line is None:
+                return 0
+            if line.strip():
+                self.pending = line if line.endswith(b'\n') else line + b'\n'
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        self.lines.close()
+        super().close()
@@ -0,0 +1,196 @@
+""" ETL instrumentation
+
+Times the stages of the ETL pipeline in `etl.py` (parse, transform, lookup,
+insert, and commit) for every file, counts the rows loaded, and summarizes
+the stage timings with percentiles. Per-file records can be streamed to a
+JSON lines file as they complete.
+"""
+
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+import numpy as np
+
+
+STAGES = ['parse', 'transform', 'lookup', 'insert', 'commit']
+PERCENTILES = [50, 90, 99]
+
+
+class Metrics:
+    """ Collects stage timings and row counts of an ETL run.
+
+    Time spent in a `stage` between `start_file` and `end_file` is added to
+    that file's record. Stages outside of a file, such as batch commits or
+    building the song index, are recorded as samples of their own. Counters
+    such as matched songs are kept per file the same way, and summed.
+
+    Attributes:
+        sink (file): open JSON lines file the records are written to, or
+            `None` to only keep them in memory
+        records (list): file and stage records in the order they completed
+        files (list): the file records, one `dict` per processed file
+        samples (collections.defaultdict): stage name to list of durations in
+            seconds, one per file or per stage call outside of a file
+        counts (collections.defaultdict): counter name to its total
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.reset()
+
+    def reset(self):
+        """ Discards all recorded timings. """
+        self.records = []
+        self.files = []
+        self.samples = defaultdict(list)
+        self.counts = defaultdict(int)
+        self.current = None
+
+    @contextmanager
+    def stage(self, name):
+        """ Times the enclosed block as stage `name`.
+
+        Args:
+            name (str): stage name, normally one of `STAGES`
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.current is not None:
+                stages = self.current['stages']
+                stages[name] = stages.get(name, 0.0) + elapsed
+            else:
+                self.record({'type': 'stage', 'stage': name, \
+                             'seconds': elapsed})
+
+    def count(self, name, value):
+        """ Adds `value` to counter `name` of the current file.
+
+        Outside of a file the value is added to the totals directly.
+
+        Args:
+            name (str): counter name
+            value (int): amount to add
+        Returns:
+            `None`: actions performed, but no return value
+        """
+        if self.current is not None:
+            counts = self.current['counts']
+            counts[name] = counts.get(name, 0) + value
+        else:
+            self.counts[name] += value
+
+    def start_file(self, filepath):
+        """ Starts the record of the file at `filepath`. """
+        self.current = {'type': 'file', 'file': filepath, 'rows': 0, \
+                        'seconds': time.perf_counter(), 'stages': {}, \
+                        'counts': {}}
+
+    def end_file(self, rows, error=None):
+        """ Completes the record of the current file.
+
+        Args:
+            rows (int): number of rows loaded from the file
+            error (str): reason the file was skipped, if it failed
+        Returns:
+            `None`: actions performed, but no return value
+        """
+        record, self.current = self.current, None
+        record['seconds'] = time.perf_counter() - record['seconds']
+        record['rows'] = rows
+        if error:
+            record['error'] = error
+        self.record(record)
+
+    def record(self, record):
+        """ Adds a file or stage record, e.g. one returned by `drain`.
+
+        Args:
+            record (dict): record created by `stage` or `end_file`
+        Returns:
+            `None`: actions performed, but no return value
+        """
+        self.records.append(record)
+        if record['type'] == 'file':
+            self.files.append(record)
+            for name, seconds in record['stages'].items():
+                self.samples[name].append(seconds)
+            for name, value in record.get('counts', {}).items():
+                self.counts[name] += value
+        else:
+            self.samples[record['stage']].append(record['seconds'])
+
+        if self.sink:
+            self.sink.write(json.dumps(record) + '\n')
+
+    def drain(self):
+        """ Returns and forgets the records collected so far.
+
+        Used by pool workers to hand their records to the parent process,
+        which adds them with `record`.
+
+        Returns:
+            list: file and stage records
+        """
+        records = self.records
+        self.reset()
+        return records
+
+    def summary(self):
+        """ Aggregates the recorded timings.
+
+        Returns:
+            dict: file and row totals, counter totals, and per stage the
+                number of samples, total and mean seconds, percentiles, and
+                maximum
+        """
+        stages = {}
+        for name, samples in self.samples.items():
+            values = np.array(samples)
+            stages[name] = {'count': len(values),
+                            'total': values.sum(),
+                            'mean': values.mean(),
+                            'max': values.max()}
+            for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                stages[name]['p{}'.format(p)] = value
+
+        return {'type': 'summary',
+                'files': len(self.files),
+                'skipped': sum(1 for f in self.files if 'error' in f),
+                'rows': sum(f['rows'] for f in self.files),
+                'seconds': sum(f['seconds'] for f in self.files),
+                'counts': dict(self.counts),
+                'stages': stages}
+
+    def report(self):
+        """ Prints the summary as a table and writes it to the sink.
+
+        Returns:
+            dict: the summary as returned by `summary`
+        """
+        summary = self.summary()
+        if self.sink:
+            self.sink.write(json.dumps(summary) + '\n')
+
+        print('{} files, {} skipped, {} rows in {:.2f}s of file processing' \
+              .format(summary['files'], summary['skipped'], summary['rows'], \
+                      summary['seconds']))
+        header = ['stage', 'count', 'total s', 'mean ms'] + \
+                 ['p{} ms'.format(p) for p in PERCENTILES] + ['max ms']
+        print(('{:<10}' + ' {:>10}' * (len(header) - 1)).format(*header))
+
+        names = [name for name in STAGES if name in summary['stages']] + \
+                sorted(set(summary['stages']) - set(STAGES))
+        for name in names:
+            stage = summary['stages'][name]
+            values = [stage['mean']] + \
+                     [stage['p{}'.format(p)] for p in PERCENTILES] + \
+                     [stage['max']]
+            print(('{:<10} {:>10} {:>10.2f}' + ' {:>10.2f}' * len(values)) \
+                  .format(name, stage['count'], stage['total'], \
+                          *[value * 1000 for value in values]))
+
+        return summary
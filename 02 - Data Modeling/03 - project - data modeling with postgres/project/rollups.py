@@ -0,0 +1,94 @@
+""" Songplay rollup queries
+
+Reads the dashboard aggregates from the `hourly_plays` and `daily_user_plays`
+rollup tables maintained by `etl.py`, instead of aggregating `songplays`.
+Date ranges include `start` and exclude `end`.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import psycopg2
+from sql_queries import plays_per_hour_select, plays_per_day_select, \
+                        plays_per_level_select, plays_per_user_select, \
+                        user_daily_plays_select
+from etl import SPARKIFY_DSN
+
+
+def plays_per_hour(cur, start, end):
+    """ Returns (hour, plays) for every hour with plays in the range. """
+    cur.execute(plays_per_hour_select, (start, end))
+    return cur.fetchall()
+
+
+def plays_per_day(cur, start, end):
+    """ Returns (day, plays) for every day with plays in the range. """
+    cur.execute(plays_per_day_select, (start, end))
+    return cur.fetchall()
+
+
+def plays_per_level(cur, start, end):
+    """ Returns (level, plays) of the free and paid plays in the range. """
+    cur.execute(plays_per_level_select, (start, end))
+    return cur.fetchall()
+
+
+def top_users(cur, start, end, limit=10):
+    """ Returns the users with the most plays in the range.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        start (datetime.date): first day of the range
+        end (datetime.date): day after the last day of the range
+        limit (int): number of users returned
+    Returns:
+        list: (user_id, first_name, last_name, plays), most plays first
+    """
+    cur.execute(plays_per_user_select, (start, end, limit))
+    return cur.fetchall()
+
+
+def user_daily_plays(cur, user_id, start, end):
+    """ Returns (day, plays) of one user for every day they played songs. """
+    cur.execute(user_daily_plays_select, (user_id, start, end))
+    return cur.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prints the songplay '
+                                                 'rollups of a date range.')
+    parser.add_argument('--start', default='2018-11-01',
+                        help='first day, as YYYY-MM-DD')
+    parser.add_argument('--end',
+                        help='day after the last day, default 7 days later')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of users listed')
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, '%Y-%m-%d').date()
+    if args.end:
+        end = datetime.strptime(args.end, '%Y-%m-%d').date()
+    else:
+        end = start + timedelta(days=7)
+
+    conn = psycopg2.connect(SPARKIFY_DSN)
+    cur = conn.cursor()
+
+    print('plays per day')
+    for day, plays in plays_per_day(cur, start, end):
+        print('    {} {:>8}'.format(day, plays))
+
+    print('plays per level')
+    for level, plays in plays_per_level(cur, start, end):
+        print('    {:<10} {:>8}'.format(level, plays))
+
+    print('top users')
+    for user_id, first_name, last_name, plays in \
+            top_users(cur, start, end, args.top):
+        print('    {:>6} {:<24} {:>8}'.format(user_id, \
+              '{} {}'.format(first_name, last_name), plays))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+""" Song data cache
+
+Packs the one-record files of the `data/song_data` tree into a single Parquet
+file, so `etl.py` can load the songs without opening thousands of files. Next
+to the song records, the cache keeps a manifest of every source file with its
+size, modification time, and content hash. Refreshing the cache only re-reads
+files whose size or modification time changed.
+
+Reading and writing Parquet requires `pyarrow`.
+"""
+
+import os
+import argparse
+import pandas as pd
+
+
+SONG_CACHE = 'data/song_data.parquet'
+MANIFEST_COLUMNS = ['filepath', 'size', 'mtime', 'content_hash']
+SONG_COLUMNS = ['num_songs', 'artist_id', 'artist_latitude', \
+                'artist_longitude', 'artist_location', 'artist_name', \
+                'song_id', 'title', 'duration', 'year']
+# integer fields stay integers next to the null rows of empty files
+SONG_DTYPES = {'num_songs': 'Int64', 'year': 'Int64', \
+               'artist_latitude': 'float64', 'artist_longitude': 'float64', \
+               'duration': 'float64'}
+
+
+class SongCache:
+    """ Song records of a song data tree with the manifest of their files.
+
+    Attributes:
+        df (pandas.DataFrame): one row per song record with the manifest
+            columns of its file; a file without records has one row whose
+            song columns are null
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self._records = None
+
+    @classmethod
+    def load(cls, path):
+        """ Returns the cache stored at `path`, or `None` if there is none. """
+        if not os.path.exists(path):
+            return None
+        return cls(pd.read_parquet(path))
+
+    def save(self, path):
+        """ Writes the cache to `path`, replacing it only once complete. """
+        tmp_path = path + '.tmp'
+        self.df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    def fingerprints(self):
+        """ Returns the (size, mtime, content hash) of each cached file. """
+        manifest = self.df.drop_duplicates('filepath')
+        return {filepath: (int(size), float(mtime), content_hash) \
+                for filepath, size, mtime, content_hash in \
+                manifest[MANIFEST_COLUMNS].itertuples(index=False)}
+
+    def records(self, filepath):
+        """ Returns the song records of a cached file as dicts.
+
+        Args:
+            filepath (str): absolute filepath of a file in the manifest
+        Returns:
+            list: records shaped like those returned by `read_json_lines`
+        """
+        if self._records is None:
+            songs_df = self.df[self.df.song_id.notna()]
+            songs_df = songs_df.astype(object) \
+                               .where(songs_df.notna(), None)
+            self._records = {}
+            for record in songs_df.to_dict('records'):
+                self._records.setdefault(record['filepath'], []) \
+                             .append(record)
+        return self._records.get(filepath, [])
+
+    def refresh(self, filepath):
+        """ Returns the cache updated to the current song data tree.
+
+        Files whose size and modification time match the manifest keep their
+        cached rows; new and changed files are read, and deleted files are
+        dropped.
+
+        Args:
+            filepath (str): root of the song data tree
+        Returns:
+            tuple: the updated `SongCache` and the number of files read
+        """
+        from etl import iter_json_files, read_json_lines, file_fingerprint
+
+        cached = self.fingerprints()
+        unchanged = set()
+        frames = []
+        read = 0
+        for datafile in iter_json_files(filepath):
+            stat = os.stat(datafile)
+            loaded = cached.get(datafile)
+            if loaded and loaded[:2] == (stat.st_size, stat.st_mtime):
+                unchanged.add(datafile)
+                continue
+
+            size, mtime, content_hash = file_fingerprint(datafile)
+            records = read_json_lines(datafile) or [{}]
+            file_df = pd.DataFrame.from_records(records, columns=SONG_COLUMNS)
+            file_df.insert(0, 'filepath', datafile)
+            file_df.insert(1, 'size', size)
+            file_df.insert(2, 'mtime', mtime)
+            file_df.insert(3, 'content_hash', content_hash)
+            frames.append(file_df)
+            read += 1
+
+        frames.insert(0, self.df[self.df.filepath.isin(unchanged)])
+        df = pd.concat(frames, ignore_index=True).astype(SONG_DTYPES)
+        return SongCache(df), read
+
+    @classmethod
+    def empty(cls):
+        """ Returns a cache without any files. """
+        return cls(pd.DataFrame(columns=MANIFEST_COLUMNS + SONG_COLUMNS) \
+                     .astype(dict(SONG_DTYPES, size='int64', mtime='float64')))
+
+
+def update_cache(filepath, path):
+    """ Builds or refreshes the cache of a song data tree.
+
+    Args:
+        filepath (str): root of the song data tree
+        path (str): filepath of the Parquet cache
+    Returns:
+        SongCache: the cache as written to `path`
+    """
+    cache = SongCache.load(path) or SongCache.empty()
+    num_cached = cache.df.filepath.nunique()
+    cache, read = cache.refresh(filepath)
+
+    num_files = cache.df.filepath.nunique()
+    if read or num_files != num_cached or not os.path.exists(path):
+        cache.save(path)
+
+    print('{} files cached in {}, {} read'.format(num_files, path, read))
+    return cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Packs the song data tree '
+                                                 'into a Parquet cache.')
+    parser.add_argument('--data', default='data/song_data',
+                        help='root of the song data tree')
+    parser.add_argument('--cache', default=SONG_CACHE,
+                        help='filepath of the Parquet cache')
+    args = parser.parse_args()
+
+    update_cache(args.data, args.cache)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,23 +5,45 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+user_event_table_drop = "DROP TABLE IF EXISTS user_events"
+load_ledger_table_drop = "DROP TABLE IF EXISTS load_ledger"
+hourly_plays_table_drop = "DROP TABLE IF EXISTS hourly_plays"
+daily_user_plays_table_drop = "DROP TABLE IF EXISTS daily_user_plays"
+rollup_watermark_table_drop = "DROP TABLE IF EXISTS rollup_watermark"
+load_generation_table_drop = "DROP TABLE IF EXISTS load_generation"
+normalize_name_function_drop = "DROP FUNCTION IF EXISTS normalize_name(text)"
 
 # CREATE TABLES
 
 #Fact table
+# partitioned by month of start_time, so the key has to include start_time
 songplay_table_create = ("""
 CREATE TABLE IF NOT EXISTS songplays
-(songplay_id SERIAL PRIMARY KEY,
+(songplay_id SERIAL,
  start_time TIMESTAMP NOT NULL,
  user_id INTEGER NOT NULL,
  level VARCHAR,
- song_id VARCHAR,
- artist_id VARCHAR,
+ song_key INTEGER,
+ artist_key INTEGER,
  session_id INTEGER,
  location TEXT,
- user_agent TEXT
-);
+ user_agent TEXT,
+ file_id INTEGER DEFAULT NULLIF(current_setting('sparkify.file_id', true), '')::integer,
+ PRIMARY KEY (songplay_id, start_time)
+) PARTITION BY RANGE (start_time);
+""")
+# notes:
+# song_key and artist_key are the surrogate keys of songs and artists
+# file_id is the `load_ledger` entry of the log file a songplay came from,
+# taken from the setting `load_file_tag` makes for the file being loaded
+
+# catches months without a partition of their own until they are split off
+songplay_default_partition_create = ("""
+CREATE TABLE IF NOT EXISTS songplays_default
+PARTITION OF songplays DEFAULT;
 """)
+# notes:
+# monthly partitions are named songplays_YYYY_MM, see SONGPLAY PARTITIONS
 
 #Dimension tables
 
@@ -40,7 +62,8 @@ CREATE TABLE IF NOT EXISTS users
 
 song_table_create = ("""
 CREATE TABLE IF NOT EXISTS songs
-(song_id VARCHAR PRIMARY KEY,
+(song_key SERIAL PRIMARY KEY,
+ song_id VARCHAR NOT NULL UNIQUE,
  title VARCHAR NOT NULL,
  artist_id VARCHAR NOT NULL,
  year INTEGER,
@@ -50,13 +73,18 @@ CREATE TABLE IF NOT EXISTS songs
 
 artist_table_create = ("""
 CREATE TABLE IF NOT EXISTS artists
-(artist_id VARCHAR PRIMARY KEY,
+(artist_key SERIAL PRIMARY KEY,
+ artist_id VARCHAR NOT NULL UNIQUE,
  name VARCHAR,
  location TEXT,
  latitude NUMERIC,
  longitude NUMERIC
 );
 """)
+# notes:
+# song_key and artist_key are compact surrogate keys referenced by songplays;
+# song_id and artist_id are the natural IDs of the song data, e.g.
+# 'SOMZWCG12A8C13C480' and 'ARD7TVE1187B99BFB1'
 
 time_table_create = ("""
 CREATE TABLE IF NOT EXISTS time
@@ -70,11 +98,135 @@ CREATE TABLE IF NOT EXISTS time
 );
 """)
 
+#Staging table for the user events of a load run
+# unlogged, since its rows only live until the end of the load
+
+user_event_table_create = ("""
+CREATE UNLOGGED TABLE IF NOT EXISTS user_events
+(user_id INTEGER NOT NULL,
+ first_name VARCHAR,
+ last_name VARCHAR,
+ gender CHAR(1),
+ level CHAR(4),
+ start_time TIMESTAMP NOT NULL
+);
+""")
+
+#Ledger of loaded input files
+
+load_ledger_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_ledger
+(file_id SERIAL UNIQUE,
+ filepath TEXT PRIMARY KEY,
+ size BIGINT NOT NULL,
+ mtime DOUBLE PRECISION NOT NULL,
+ content_hash CHAR(64) NOT NULL,
+ loaded_at TIMESTAMP NOT NULL DEFAULT now()
+);
+""")
+# notes:
+# content_hash is the hex SHA-256 digest of the file
+# mtime is in seconds since the epoch, as returned by os.stat
+
+#Rollup tables of songplays for the dashboards
+
+hourly_plays_table_create = ("""
+CREATE TABLE IF NOT EXISTS hourly_plays
+(hour TIMESTAMP NOT NULL,
+ level CHAR(4) NOT NULL,
+ plays INTEGER NOT NULL,
+ PRIMARY KEY (hour, level)
+);
+""")
+
+daily_user_plays_table_create = ("""
+CREATE TABLE IF NOT EXISTS daily_user_plays
+(day DATE NOT NULL,
+ user_id INTEGER NOT NULL,
+ plays INTEGER NOT NULL,
+ PRIMARY KEY (day, user_id)
+);
+""")
+
+rollup_watermark_table_create = ("""
+CREATE TABLE IF NOT EXISTS rollup_watermark
+(name TEXT PRIMARY KEY,
+ songplay_id BIGINT NOT NULL
+);
+""")
+# notes:
+# songplay_id is the highest songplay already counted in the rollups
+
+#Load generations for caches of query results
+
+load_generation_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_generation
+(name TEXT PRIMARY KEY,
+ generation BIGINT NOT NULL,
+ changed_at TIMESTAMP NOT NULL DEFAULT now()
+);
+""")
+# notes:
+# name is 'songs' (songs and artists), 'songplays', 'users', or 'rollups'
+# generation counts the commits that changed those tables
+
+# same normalization as `etl.normalize_names`, so the set-based song matches
+# of `elt.py` and `etl.py --bulk` agree with `etl.SongIndex`
+
+normalize_name_function_create = ("""
+CREATE OR REPLACE FUNCTION normalize_name(name TEXT) RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$ SELECT lower(btrim(regexp_replace(name, '[[:space:]]+', ' ', 'g'))) $$;
+""")
+
+# CREATE INDEXES
+
+# lookup indexes for `song_select`; they are not needed for integrity, so bulk
+# loads may drop them and rebuild them once afterwards
+song_lookup_index_create = ("""
+CREATE INDEX IF NOT EXISTS songs_title_duration_idx
+ON songs (title, duration);
+""")
+
+artist_name_index_create = ("""
+CREATE INDEX IF NOT EXISTS artists_name_idx
+ON artists (name);
+""")
+
+# lookup index for the normalized song matches
+song_name_index_create = ("""
+CREATE INDEX IF NOT EXISTS songs_normalized_title_idx
+ON songs (normalize_name(title));
+""")
+
+# history of a user across all partitions, see `analytics.py`
+songplay_user_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplays_user_time_idx
+ON songplays (user_id, start_time);
+""")
+
+# songplays of a reloaded file, see `songplay_file_delete`
+songplay_file_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplays_file_idx
+ON songplays (file_id);
+""")
+
+# DROP INDEXES
+
+song_lookup_index_drop = "DROP INDEX IF EXISTS songs_title_duration_idx"
+artist_name_index_drop = "DROP INDEX IF EXISTS artists_name_idx"
+song_name_index_drop = "DROP INDEX IF EXISTS songs_normalized_title_idx"
+songplay_user_index_drop = "DROP INDEX IF EXISTS songplays_user_time_idx"
+songplay_file_index_drop = "DROP INDEX IF EXISTS songplays_file_idx"
+
+# refresh planner statistics after rebuilding the indexes
+lookup_tables_analyze = "ANALYZE songs, artists"
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
 INSERT INTO songplays
-(start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+(start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
 VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
 """)
 
@@ -86,6 +238,21 @@ ON CONFLICT (user_id)
 DO UPDATE SET level=EXCLUDED.level
 """)
 
+user_event_bulk_insert = ("""
+INSERT INTO user_events
+(user_id, first_name, last_name, gender, level, start_time)
+VALUES %s
+""")
+
+# all rows of a batch in one statement, see `psycopg2.extras.execute_values`
+time_table_bulk_insert = ("""
+INSERT INTO time
+(start_time, hour, day, week, month, year, weekday)
+VALUES %s
+ON CONFLICT (start_time)
+DO NOTHING
+""")
+
 song_table_insert = ("""
 INSERT INTO songs
 (song_id, title, artist_id, year, duration)
@@ -110,16 +277,570 @@ ON CONFLICT (start_time)
 DO NOTHING
 """)
 
+# STAGING TABLES
+
+# temporary tables are session-local and never written to the WAL
+log_staging_table_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS log_staging
+(start_time TIMESTAMP NOT NULL,
+ user_id INTEGER NOT NULL,
+ level CHAR(4),
+ song VARCHAR,
+ artist VARCHAR,
+ length DECIMAL,
+ song_key INTEGER,
+ artist_key INTEGER,
+ session_id INTEGER,
+ location TEXT,
+ user_agent TEXT
+);
+""")
+
+log_staging_truncate = "TRUNCATE log_staging"
+
+log_staging_copy = ("""
+COPY log_staging
+(start_time, user_id, level,
+ song, artist, length, song_key, artist_key, session_id, location, user_agent)
+FROM STDIN WITH (FORMAT csv, NULL '\\N')
+""")
+
+# binary COPY, see `binary_copy.py`; time rows go through a staging table to
+# keep the ON CONFLICT of `time_table_bulk_insert`
+songplay_binary_copy = ("""
+COPY songplays
+(start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
+FROM STDIN WITH (FORMAT binary)
+""")
+
+time_staging_table_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS time_staging
+(start_time TIMESTAMP NOT NULL,
+ hour INTEGER,
+ day INTEGER,
+ week INTEGER,
+ month INTEGER,
+ year INTEGER,
+ weekday TEXT
+);
+""")
+
+time_staging_truncate = "TRUNCATE time_staging"
+
+time_staging_binary_copy = ("""
+COPY time_staging
+(start_time, hour, day, week, month, year, weekday)
+FROM STDIN WITH (FORMAT binary)
+""")
+
+# MERGE STAGED RECORDS
+
+time_staging_insert = ("""
+INSERT INTO time
+(start_time, hour, day, week, month, year, weekday)
+SELECT start_time, hour, day, week, month, year, weekday
+FROM time_staging
+ON CONFLICT (start_time)
+DO NOTHING
+""")
+
+# set-based equivalent of `etl.SongIndex` for every staged event: nearest
+# duration within the tolerance, then the shorter song and the lowest song_id,
+# else with `fallback` the lowest song_id of the same title and artist
+songplay_staging_lookup_insert = ("""
+INSERT INTO songplays
+(start_time, user_id, level, song_key, artist_key, session_id, location, user_agent)
+SELECT log_staging.start_time, log_staging.user_id, log_staging.level,
+       matches.song_key, matches.artist_key,
+       log_staging.session_id, log_staging.location, log_staging.user_agent
+FROM log_staging
+LEFT JOIN LATERAL
+    (SELECT songs.song_key, artists.artist_key
+     FROM songs
+     JOIN artists ON songs.artist_id = artists.artist_id
+     CROSS JOIN LATERAL
+         (SELECT abs(songs.duration - log_staging.length) AS distance) gap
+     WHERE normalize_name(songs.title) = normalize_name(log_staging.song)
+       AND normalize_name(artists.name) = normalize_name(log_staging.artist)
+       AND (%(fallback)s OR gap.distance <= %(tolerance)s)
+     ORDER BY CASE WHEN gap.distance <= %(tolerance)s THEN gap.distance END,
+              CASE WHEN gap.distance <= %(tolerance)s THEN songs.duration END,
+              songs.song_id
+     LIMIT 1) matches ON true
+""")
+
+load_ledger_insert = ("""
+INSERT INTO load_ledger
+(filepath, size, mtime, content_hash)
+VALUES (%s, %s, %s, %s)
+ON CONFLICT (filepath)
+DO UPDATE SET size=EXCLUDED.size, mtime=EXCLUDED.mtime,
+              content_hash=EXCLUDED.content_hash, loaded_at=now()
+RETURNING file_id
+""")
+
+# RELOAD CHANGED FILES
+
+load_ledger_file_select = ("""
+SELECT file_id
+FROM load_ledger
+WHERE filepath = %s;
+""")
+
+# rows of an earlier version of a file, replaced by its reload
+songplay_file_delete = "DELETE FROM songplays WHERE file_id = %s"
+
+# tags the rows inserted next in the transaction with the file's ledger entry
+load_file_tag = "SELECT set_config('sparkify.file_id', %s, true)"
+
+# MERGE USER EVENTS
+
+# one row per user so the upsert never touches a row twice; the latest event
+# wins regardless of the order files were loaded
+# only the events it deletes are merged, so events staged by a load that
+# commits meanwhile stay for the next merge
+user_event_merge = ("""
+WITH consumed AS (
+    DELETE FROM user_events
+    RETURNING user_id, first_name, last_name, gender, level, start_time
+)
+INSERT INTO users
+(user_id, first_name,last_name, gender, level)
+SELECT DISTINCT ON (user_id) user_id, first_name, last_name, gender, level
+FROM consumed
+ORDER BY user_id, start_time DESC
+ON CONFLICT (user_id)
+DO UPDATE SET level=EXCLUDED.level
+""")
+
+# ELT STAGING TABLES
+
+# one raw JSON document per row, as COPY'd from the song and log files
+raw_song_table_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS raw_songs
+(doc JSONB NOT NULL
+);
+""")
+
+raw_event_table_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS raw_events
+(doc JSONB NOT NULL,
+ file_id INTEGER DEFAULT NULLIF(current_setting('sparkify.file_id', true), '')::integer
+);
+""")
+
+# csv with quote and delimiter characters that cannot occur in a JSON line,
+# so each line arrives unchanged as one value
+raw_song_copy = ("""
+COPY raw_songs (doc)
+FROM STDIN WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')
+""")
+
+raw_event_copy = ("""
+COPY raw_events (doc)
+FROM STDIN WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')
+""")
+
+raw_tables_truncate = "TRUNCATE raw_songs, raw_events"
+
+# ELT INSERTS
+
+elt_song_insert = ("""
+INSERT INTO songs
+(song_id, title, artist_id, year, duration)
+SELECT doc->>'song_id',
+       doc->>'title',
+       doc->>'artist_id',
+       (doc->>'year')::integer,
+       (doc->>'duration')::decimal
+FROM raw_songs
+ON CONFLICT (song_id)
+DO NOTHING
+""")
+
+elt_artist_insert = ("""
+INSERT INTO artists
+(artist_id, name, location, latitude, longitude)
+SELECT doc->>'artist_id',
+       doc->>'artist_name',
+       doc->>'artist_location',
+       (doc->>'artist_latitude')::numeric,
+       (doc->>'artist_longitude')::numeric
+FROM raw_songs
+ON CONFLICT (artist_id)
+DO NOTHING
+""")
+
+# ts is in epoch milliseconds; the interval arithmetic keeps them exact
+elt_time_insert = ("""
+INSERT INTO time
+(start_time, hour, day, week, month, year, weekday)
+SELECT start_time,
+       EXTRACT(hour FROM start_time),
+       EXTRACT(day FROM start_time),
+       EXTRACT(week FROM start_time),
+       EXTRACT(month FROM start_time),
+       EXTRACT(year FROM start_time),
+       to_char(start_time, 'FMDay')
+FROM (SELECT DISTINCT timestamp 'epoch'
+                      + (doc->>'ts')::bigint * interval '1 millisecond'
+                      AS start_time
+      FROM raw_events
+      WHERE doc->>'page' = 'NextSong') events
+ON CONFLICT (start_time)
+DO NOTHING
+""")
+
+# each user's latest event decides their level, as in `user_event_merge`
+elt_user_insert = ("""
+INSERT INTO users
+(user_id, first_name, last_name, gender, level)
+SELECT DISTINCT ON (user_id) user_id, first_name, last_name, gender, level
+FROM (SELECT (doc->>'userId')::integer AS user_id,
+             doc->>'firstName' AS first_name,
+             doc->>'lastName' AS last_name,
+             doc->>'gender' AS gender,
+             doc->>'level' AS level,
+             (doc->>'ts')::bigint AS ts
+      FROM raw_events
+      WHERE doc->>'page' = 'NextSong') events
+ORDER BY user_id, ts DESC
+ON CONFLICT (user_id)
+DO UPDATE SET level=EXCLUDED.level
+""")
+
+elt_songplay_insert = ("""
+INSERT INTO songplays
+(start_time, user_id, level, song_key, artist_key, session_id, location, user_agent,
+ file_id)
+SELECT timestamp 'epoch' + (events.doc->>'ts')::bigint * interval '1 millisecond',
+       (events.doc->>'userId')::integer,
+       events.doc->>'level',
+       matches.song_key,
+       matches.artist_key,
+       (events.doc->>'sessionId')::integer,
+       events.doc->>'location',
+       events.doc->>'userAgent',
+       events.file_id
+FROM raw_events events
+LEFT JOIN LATERAL
+    (SELECT songs.song_key, artists.artist_key
+     FROM songs
+     JOIN artists ON songs.artist_id = artists.artist_id
+     CROSS JOIN LATERAL
+         (SELECT abs(songs.duration - (events.doc->>'length')::decimal)
+                 AS distance) gap
+     WHERE normalize_name(songs.title) = normalize_name(events.doc->>'song')
+       AND normalize_name(artists.name) = normalize_name(events.doc->>'artist')
+       AND (%(fallback)s OR gap.distance <= %(tolerance)s)
+     ORDER BY CASE WHEN gap.distance <= %(tolerance)s THEN gap.distance END,
+              CASE WHEN gap.distance <= %(tolerance)s THEN songs.duration END,
+              songs.song_id
+     LIMIT 1) matches ON true
+WHERE events.doc->>'page' = 'NextSong'
+""")
+
+# SONGPLAY PARTITIONS
+
+# serializes partition changes between concurrent loads
+songplay_partition_lock = "SELECT pg_advisory_xact_lock(hashtext('songplays'))"
+
+songplay_default_months = ("""
+SELECT DISTINCT to_char(start_time, 'YYYY-MM-01')
+FROM songplays_default
+ORDER BY 1;
+""")
+
+# a new partition may not overlap rows of the default partition, so the rows
+# of the month are set aside, the partition is created, and they are put back
+songplay_month_set_aside = ("""
+CREATE TEMP TABLE songplays_month ON COMMIT DROP AS
+WITH moved AS
+    (DELETE FROM songplays_default
+     WHERE start_time >= %(start)s AND start_time < %(end)s
+     RETURNING *)
+SELECT * FROM moved;
+""")
+
+# whether a concurrent load already attached the month's partition
+songplay_partition_attached = ("""
+SELECT EXISTS
+    (SELECT 1 FROM pg_inherits
+     WHERE inhparent = 'songplays'::regclass
+       AND inhrelid = to_regclass(%(name)s));
+""")
+
+# partition name and bounds are literals, filled in with str.format
+# fails if a detached partition of the month still has its name
+songplay_partition_create = ("""
+CREATE TABLE {name}
+PARTITION OF songplays
+FOR VALUES FROM ('{start}') TO ('{end}');
+""")
+
+songplay_month_restore = ("""
+INSERT INTO songplays
+SELECT * FROM songplays_month;
+""")
+
+# UPDATE ROLLUPS
+
+# locks the watermark row so concurrent updates do not count songplays twice
+rollup_watermark_select = ("""
+INSERT INTO rollup_watermark (name, songplay_id)
+VALUES ('songplays', 0)
+ON CONFLICT (name) DO UPDATE SET name=EXCLUDED.name
+RETURNING songplay_id;
+""")
+
+songplay_max_id_select = "SELECT COALESCE(MAX(songplay_id), 0) FROM songplays"
+
+hourly_plays_update = ("""
+INSERT INTO hourly_plays (hour, level, plays)
+SELECT date_trunc('hour', start_time), level, COUNT(*)
+FROM songplays
+WHERE songplay_id > %s AND songplay_id <= %s
+GROUP BY 1, 2
+ON CONFLICT (hour, level)
+DO UPDATE SET plays=hourly_plays.plays + EXCLUDED.plays
+""")
+
+daily_user_plays_update = ("""
+INSERT INTO daily_user_plays (day, user_id, plays)
+SELECT start_time::date, user_id, COUNT(*)
+FROM songplays
+WHERE songplay_id > %s AND songplay_id <= %s
+GROUP BY 1, 2
+ON CONFLICT (day, user_id)
+DO UPDATE SET plays=daily_user_plays.plays + EXCLUDED.plays
+""")
+
+rollup_watermark_update = ("""
+UPDATE rollup_watermark
+SET songplay_id = %s
+WHERE name = 'songplays'
+""")
+
+rollup_reset = "TRUNCATE hourly_plays, daily_user_plays, rollup_watermark"
+
+# READ ROLLUPS
+
+plays_per_hour_select = ("""
+SELECT hour, SUM(plays)
+FROM hourly_plays
+WHERE hour >= %s AND hour < %s
+GROUP BY hour
+ORDER BY hour;
+""")
+
+plays_per_day_select = ("""
+SELECT hour::date AS day, SUM(plays)
+FROM hourly_plays
+WHERE hour >= %s AND hour < %s
+GROUP BY day
+ORDER BY day;
+""")
+
+plays_per_level_select = ("""
+SELECT level, SUM(plays)
+FROM hourly_plays
+WHERE hour >= %s AND hour < %s
+GROUP BY level
+ORDER BY level;
+""")
+
+plays_per_user_select = ("""
+SELECT daily_user_plays.user_id, users.first_name, users.last_name,
+       SUM(daily_user_plays.plays) AS plays
+FROM daily_user_plays
+LEFT JOIN users ON daily_user_plays.user_id = users.user_id
+WHERE daily_user_plays.day >= %s AND daily_user_plays.day < %s
+GROUP BY daily_user_plays.user_id, users.first_name, users.last_name
+ORDER BY plays DESC, daily_user_plays.user_id
+LIMIT %s;
+""")
+
+user_daily_plays_select = ("""
+SELECT day, plays
+FROM daily_user_plays
+WHERE user_id = %s AND day >= %s AND day < %s
+ORDER BY day;
+""")
+
+# LOAD GENERATIONS
+
+# advances a generation in the loading transaction; the notification is only
+# delivered to listeners once that transaction commits
+load_generation_bump = ("""
+WITH bumped AS
+    (INSERT INTO load_generation (name, generation)
+     VALUES (%s, 1)
+     ON CONFLICT (name)
+     DO UPDATE SET generation = load_generation.generation + 1,
+                   changed_at = now()
+     RETURNING name, generation)
+SELECT pg_notify('sparkify_load', name || ':' || generation)
+FROM bumped;
+""")
+
+load_generation_listen = "LISTEN sparkify_load"
+
+load_generation_select = ("""
+SELECT name, generation
+FROM load_generation;
+""")
+
+# ANALYTICS QUERIES
+
+# served through the result cache of `analytics.py`
+
+analytics_top_songs_select = ("""
+SELECT songs.title, artists.name, COUNT(*) AS plays
+FROM songplays
+JOIN songs ON songplays.song_key = songs.song_key
+JOIN artists ON songplays.artist_key = artists.artist_key
+WHERE songplays.start_time >= %s AND songplays.start_time < %s
+GROUP BY songs.title, artists.name
+ORDER BY plays DESC, songs.title
+LIMIT %s;
+""")
+
+analytics_user_history_select = ("""
+SELECT songplays.start_time, songs.title, artists.name, songplays.level,
+       songplays.session_id
+FROM songplays
+LEFT JOIN songs ON songplays.song_key = songs.song_key
+LEFT JOIN artists ON songplays.artist_key = artists.artist_key
+WHERE songplays.user_id = %s
+ORDER BY songplays.start_time DESC
+LIMIT %s;
+""")
+
 # FIND SONGS
 
 song_select = ("""
-SELECT songs.song_id, songs.artist_id
+SELECT songs.song_key, artists.artist_key
 FROM songs
 JOIN artists ON songs.artist_id = artists.artist_id
 WHERE songs.title = (%s) AND artists.name = (%s) AND songs.duration = (%s);
 """)
 
+song_index_select = ("""
+SELECT songs.title, artists.name, songs.duration, songs.song_id,
+       songs.song_key, artists.artist_key
+FROM songs
+JOIN artists ON songs.artist_id = artists.artist_id
+ORDER BY songs.song_id;
+""")
+
+# FILE SAVEPOINTS
+
+file_savepoint = "SAVEPOINT load_file"
+file_savepoint_release = "RELEASE SAVEPOINT load_file"
+file_savepoint_rollback = "ROLLBACK TO SAVEPOINT load_file"
+
+# FIND LOADED FILES
+
+load_ledger_select = ("""
+SELECT filepath, size, mtime, content_hash
+FROM load_ledger;
+""")
+
+# ledger entries of the files reported by `watch.py`, by primary key
+load_ledger_files_select = ("""
+SELECT filepath, size, mtime, content_hash
+FROM load_ledger
+WHERE filepath = ANY(%s);
+""")
+
+# BENCHMARK QUERIES
+
+# analyst queries timed by `benchmark_queries.py`; start and end bound the
+# month range, title, artist, and length pick an existing song
+
+top_songs_select = ("""
+SELECT songs.title, COUNT(*) AS plays
+FROM songplays
+JOIN songs ON songplays.song_key = songs.song_key
+WHERE songplays.start_time >= %(start)s AND songplays.start_time < %(end)s
+GROUP BY songs.title
+ORDER BY plays DESC
+LIMIT 10;
+""")
+
+top_artists_select = ("""
+SELECT artists.name, COUNT(*) AS plays
+FROM songplays
+JOIN artists ON songplays.artist_key = artists.artist_key
+WHERE songplays.start_time >= %(start)s AND songplays.start_time < %(end)s
+GROUP BY artists.name
+ORDER BY plays DESC
+LIMIT 10;
+""")
+
+plays_by_hour_select = ("""
+SELECT time.hour, COUNT(*) AS plays
+FROM songplays
+JOIN time ON songplays.start_time = time.start_time
+WHERE songplays.start_time >= %(start)s AND songplays.start_time < %(end)s
+GROUP BY time.hour
+ORDER BY time.hour;
+""")
+
+plays_by_weekday_select = ("""
+SELECT time.weekday, COUNT(*) AS plays
+FROM songplays
+JOIN time ON songplays.start_time = time.start_time
+WHERE songplays.start_time >= %(start)s AND songplays.start_time < %(end)s
+GROUP BY time.weekday
+ORDER BY plays DESC;
+""")
+
+user_level_plays_select = ("""
+SELECT songplays.user_id, users.first_name, users.last_name,
+       COUNT(*) FILTER (WHERE songplays.level = 'paid') AS paid_plays,
+       COUNT(*) FILTER (WHERE songplays.level = 'free') AS free_plays
+FROM songplays
+JOIN users ON songplays.user_id = users.user_id
+WHERE songplays.start_time >= %(start)s AND songplays.start_time < %(end)s
+GROUP BY songplays.user_id, users.first_name, users.last_name
+ORDER BY paid_plays + free_plays DESC
+LIMIT 20;
+""")
+
+busiest_sessions_select = ("""
+SELECT session_id, user_id, COUNT(*) AS plays,
+       MAX(start_time) - MIN(start_time) AS duration
+FROM songplays
+WHERE start_time >= %(start)s AND start_time < %(end)s
+GROUP BY session_id, user_id
+ORDER BY plays DESC
+LIMIT 10;
+""")
+
+song_lookup_select = ("""
+SELECT songs.song_key, artists.artist_key
+FROM songs
+JOIN artists ON songs.artist_id = artists.artist_id
+WHERE songs.title = %(title)s AND artists.name = %(artist)s
+  AND songs.duration = %(length)s;
+""")
+
+benchmark_song_select = ("""
+SELECT songs.title, artists.name, songs.duration
+FROM songs
+JOIN artists ON songs.artist_id = artists.artist_id
+ORDER BY songs.song_id
+LIMIT 1;
+""")
+
 # QUERY LISTS
 
-create_table_queries = [artist_table_create, time_table_create, user_table_create, song_table_create, songplay_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [normalize_name_function_create, artist_table_create, time_table_create, user_table_create, song_table_create, songplay_table_create, songplay_default_partition_create, user_event_table_create, load_ledger_table_create, hourly_plays_table_create, daily_user_plays_table_create, rollup_watermark_table_create, load_generation_table_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, user_event_table_drop, load_ledger_table_drop, hourly_plays_table_drop, daily_user_plays_table_drop, rollup_watermark_table_drop, load_generation_table_drop, normalize_name_function_drop]
+create_index_queries = [song_lookup_index_create, artist_name_index_create, song_name_index_create, songplay_user_index_create, songplay_file_index_create, lookup_tables_analyze]
+drop_index_queries = [song_lookup_index_drop, artist_name_index_drop, song_name_index_drop, songplay_user_index_drop, songplay_file_index_drop]
+elt_staging_queries = [raw_song_table_create, raw_event_table_create]
+elt_song_queries = [elt_song_insert, elt_artist_insert]
+elt_log_queries = [elt_time_insert, elt_user_insert, elt_songplay_insert]
+benchmark_queries = {'top_songs': top_songs_select, 'top_artists': top_artists_select, 'plays_by_hour': plays_by_hour_select, 'plays_by_weekday': plays_by_weekday_select, 'user_level_plays': user_level_plays_select, 'busiest_sessions': busiest_sessions_select, 'song_lookup': song_lookup_select}
\ No newline at end of file
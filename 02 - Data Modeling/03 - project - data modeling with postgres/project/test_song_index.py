@@ -0,0 +1,60 @@
+import pandas as pd
+from etl import SongIndex
+
+
+def make_index(songs):
+    return SongIndex(pd.DataFrame(songs, columns=['song_id', 'title', 'name', \
+                                                  'duration', 'song_key', \
+                                                  'artist_key']))
+
+
+def events(*rows):
+    return pd.DataFrame(list(rows), columns=['song', 'artist', 'length'])
+
+
+def test_duration_ties_go_to_lowest_song_id():
+    index = make_index([('SOB', 'Song', 'Artist', 200.0, 2, 20),
+                        ('SOA', 'Song', 'Artist', 200.0, 1, 10),
+                        ('SOC', 'Song', 'Artist', 200.0, 3, 30)])
+    matches, timed, named, unmatched = index.lookup( \
+        events(('Song', 'Artist', 200.0), ('Song', 'Artist', 200.4), \
+               ('Song', 'Artist', 199.6)))
+    assert list(matches.song_key) == [1, 1, 1]
+    assert list(matches.artist_key) == [10, 10, 10]
+    assert (timed, named, unmatched) == (3, 0, 0)
+
+
+def test_event_between_durations_takes_the_shorter_song():
+    index = make_index([('SOA', 'Song', 'Artist', 201.0, 1, 10),
+                        ('SOB', 'Song', 'Artist', 199.0, 2, 20)])
+    matches, timed, named, unmatched = index.lookup( \
+        events(('Song', 'Artist', 200.0)))
+    assert list(matches.song_key) == [2]
+
+
+def test_both_tiers_pick_the_same_song():
+    index = make_index([('SOB', 'Song', 'Artist', 200.0, 2, 20),
+                        ('SOA', 'Song', 'Artist', 200.0, 1, 10)])
+    matches, timed, named, unmatched = index.lookup( \
+        events(('Song', 'Artist', 200.0), ('Song', 'Artist', 900.0)))
+    assert list(matches.song_key) == [1, 1]
+    assert (timed, named, unmatched) == (1, 1, 0)
+
+
+def test_nearest_duration_within_tolerance():
+    index = make_index([('SOA', 'Song', 'Artist', 200.0, 1, 10),
+                        ('SOB', 'Song', 'Artist', 210.0, 2, 20),
+                        ('SOC', 'Other', 'Artist', 209.0, 3, 30)])
+    matches, timed, named, unmatched = index.lookup( \
+        events(('Song', 'Artist', 209.5), ('song ', 'ARTIST', 200.5), \
+               ('Missing', 'Artist', 200.0)))
+    assert list(matches.song_key.astype(object).fillna(0)) == [2, 1, 0]
+    assert (timed, named, unmatched) == (2, 0, 1)
+
+
+def test_empty_index_matches_nothing():
+    index = make_index([])
+    matches, timed, named, unmatched = index.lookup( \
+        events(('Song', 'Artist', 200.0)))
+    assert matches.song_key.isna().all()
+    assert (timed, named, unmatched) == (0, 0, 1)
@@ -0,0 +1,308 @@
+""" Watch-mode ingestion
+
+Keeps loading the log files that land in `data/log_data` into the same tables
+as `etl.py`, seconds after they are written, instead of rescanning the tree in
+batch runs. Files already in the tree are caught up first with `process_data`.
+
+New files are noticed through inotify when `inotify_simple` is installed, and
+otherwise by listing the tree at a fixed interval. Every file goes through
+`load_ledger` like in `etl.py`, so it is loaded exactly once, also across
+restarts, and a file that changed replaces the songplays of its earlier
+version. One database connection, the song index, and the time cache stay
+warm between files.
+
+The ingest lag of each file, from its modification time until its rows are
+committed, is recorded as the `lag` stage of `metrics` and reported with the
+stage timings at a fixed interval.
+"""
+
+import os
+import time
+import argparse
+from functools import partial
+import psycopg2
+from inputs import is_input
+from etl import SPARKIFY_DSN, MATCH_TOLERANCE, TimeCache, metrics, \
+                build_song_index, process_log_file, process_data, \
+                iter_json_files, iter_pending_files, load_batch, \
+                merge_user_events, split_default_partition, update_rollups, \
+                match_rate
+
+# inotify_simple is optional, the tree is polled without it
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class PollingWatcher:
+    """ Finds new and changed files by listing the tree every `interval`.
+
+    A file is reported once its size and modification time were the same in
+    two listings in a row, so a file still being written is not loaded early.
+    """
+
+    def __init__(self, root, interval):
+        self.root = root
+        self.interval = interval
+        self.listed = self.list_files()
+        self.reported = {}
+
+    def list_files(self):
+        """ Returns the (size, mtime) of each input file in the tree. """
+        listed = {}
+        for datafile in iter_json_files(self.root):
+            try:
+                stat = os.stat(datafile)
+            except FileNotFoundError:
+                continue
+            listed[datafile] = (stat.st_size, stat.st_mtime)
+        return listed
+
+    def poll(self):
+        """ Waits for one interval, then returns the files that are ready.
+
+        Returns:
+            list: absolute filepaths of new or changed files, sorted
+        """
+        time.sleep(self.interval)
+        listed = self.list_files()
+        ready = sorted(datafile for datafile, stat in listed.items() \
+                       if self.listed.get(datafile) == stat and \
+                       self.reported.get(datafile) != stat)
+
+        self.reported = {datafile: stat for datafile, stat in \
+                         self.reported.items() if datafile in listed}
+        self.reported.update((datafile, listed[datafile]) \
+                             for datafile in ready)
+        self.listed = listed
+        return ready
+
+
+class InotifyWatcher:
+    """ Finds files as they are closed after writing or moved into the tree.
+
+    A file moved into the tree is complete and reported at once. A file
+    closed after writing may be closed again by a writer that appends in
+    steps, so it is only reported once its size and modification time were
+    unchanged for one interval. Every directory of the tree is watched, and
+    directories created later are added as they appear. If the kernel's
+    event queue overflows, the whole tree is checked once, leaving it to
+    `load_ledger` to skip loaded files.
+    """
+
+    def __init__(self, root, interval):
+        self.root = os.path.abspath(root)
+        self.interval = interval
+        self.inotify = INotify()
+        self.directories = {}
+        # path to its (size, mtime) and when they were last seen to change
+        self.settling = {}
+        self.watch(self.root)
+
+    def watch(self, directory):
+        """ Watches `directory` and every directory below it. """
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        directories = [directory]
+        while directories:
+            directory = directories.pop()
+            # watched before it is listed, so no subdirectory is missed
+            self.directories[self.inotify.add_watch(directory, mask)] = \
+                directory
+            with os.scandir(directory) as entries:
+                directories.extend(entry.path for entry in entries \
+                                   if entry.is_dir(follow_symlinks=False))
+
+    def settle(self, paths):
+        """ Returns the files among `paths` and `settling` that are ready.
+
+        Args:
+            paths (iterable): files written since the last poll
+        Returns:
+            set: files unchanged for at least one interval
+        """
+        now = time.monotonic()
+        for path in paths:
+            self.settling[path] = (None, now)
+
+        ready = set()
+        for path, (stat, changed) in list(self.settling.items()):
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                del self.settling[path]
+                continue
+            current = (current.st_size, current.st_mtime)
+            if current != stat:
+                self.settling[path] = (current, now)
+            elif now - changed >= self.interval:
+                del self.settling[path]
+                ready.add(path)
+        return ready
+
+    def poll(self):
+        """ Waits up to one interval for events, then returns the ready files.
+
+        Returns:
+            list: absolute filepaths of new or changed files, sorted
+        """
+        ready = set()
+        written = set()
+        for event in self.inotify.read(timeout=int(self.interval * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                written.update(iter_json_files(self.root))
+                continue
+            if event.mask & flags.IGNORED:
+                self.directories.pop(event.wd, None)
+                continue
+
+            directory = self.directories.get(event.wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, event.name)
+
+            if event.mask & flags.ISDIR:
+                # files may have landed before the directory was watched
+                self.watch(path)
+                written.update(iter_json_files(path))
+            elif not is_input(event.name):
+                continue
+            elif event.mask & flags.MOVED_TO:
+                self.settling.pop(path, None)
+                ready.add(path)
+            elif event.mask & flags.CLOSE_WRITE:
+                written.add(path)
+        return sorted(ready | self.settle(written - ready))
+
+
+def ingest(cur, conn, files, func):
+    """ Loads the new or changed files among `files` and records their lag.
+
+    Files are loaded and committed as one batch with `load_batch`. The ingest
+    lag of a file is the time from its modification until the commit.
+
+    Args:
+        cur (psycopg2 connection cursor): cursor for the database connection
+        conn (psycopg2 connection): connection to database
+        files (list): absolute filepaths of files reported by a watcher
+        func (function): function object called on each file, returning the
+            number of rows it loaded
+    Returns:
+        int: number of files loaded
+    """
+    pending = list(iter_pending_files(cur, files, lookup=True))
+    skipped = dict(load_batch(cur, conn, pending, func, \
+                              generation='songplays'))
+    committed = time.time()
+
+    for datafile, (size, mtime, content_hash) in pending:
+        if datafile in skipped:
+            print('skipped {}: {}'.format(datafile, skipped[datafile]))
+            continue
+        lag = committed - mtime
+        metrics.record({'type': 'stage', 'stage': 'lag', 'seconds': lag})
+        print('loaded {} after {:.2f}s'.format(datafile, lag))
+
+    return len(pending) - len(skipped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loads new log files into '
+                                                 'the sparkifydb database as '
+                                                 'they arrive.')
+    parser.add_argument('--data', default='data/log_data',
+                        help='log data tree to watch')
+    parser.add_argument('--bulk', action='store_true',
+                        help='load log files with COPY and set-based merges')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between polls of the tree, or the '
+                             'longest wait for inotify events')
+    parser.add_argument('--poll', action='store_true',
+                        help='poll the tree even if inotify is available')
+    parser.add_argument('--report', type=float, default=300.0,
+                        help='seconds between metrics reports')
+    parser.add_argument('--maintenance', type=float, default=60.0,
+                        help='seconds between partition and rollup updates')
+    parser.add_argument('--song-refresh', type=float, default=3600.0,
+                        help='seconds between rebuilds of the song index')
+    parser.add_argument('--metrics',
+                        help='JSON lines file for per-file stage timings')
+    parser.add_argument('--match-tolerance', type=float,
+                        default=MATCH_TOLERANCE,
+                        help='largest song duration difference in seconds')
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.sink = open(args.metrics, 'a')
+
+    conn = psycopg2.connect(SPARKIFY_DSN)
+    cur = conn.cursor()
+
+    # the tree is watched before the catch-up, so no file lands unnoticed
+    if INotify is not None and not args.poll:
+        watcher = InotifyWatcher(args.data, args.interval)
+    else:
+        watcher = PollingWatcher(args.data, args.interval)
+    print('watching {} with {}'.format(args.data, type(watcher).__name__))
+
+    song_index = build_song_index(cur, args.match_tolerance)
+    time_cache = TimeCache()
+    func = partial(process_log_file, song_index=song_index, bulk=args.bulk, \
+                   time_cache=time_cache)
+    process_data(cur, conn, args.data, func, generation='songplays')
+    merge_user_events(cur, conn)
+    split_default_partition(cur, conn)
+    # reloaded files deleted songplays the rollups already counted
+    update_rollups(cur, conn, \
+                   rebuild=bool(metrics.counts.get('files_reloaded')))
+
+    last_report = last_maintenance = last_songs = time.monotonic()
+    loaded = 0
+    rebuild = False
+    try:
+        while True:
+            now = time.monotonic()
+            if now - last_songs >= args.song_refresh:
+                with metrics.stage('index'):
+                    song_index = build_song_index(cur, args.match_tolerance)
+                # upserts cover the time rows, so the cache can start over
+                time_cache = TimeCache()
+                func = partial(func, song_index=song_index, \
+                               time_cache=time_cache)
+                last_songs = now
+
+            if loaded and now - last_maintenance >= args.maintenance:
+                with metrics.stage('partition'):
+                    split_default_partition(cur, conn)
+                with metrics.stage('rollup'):
+                    update_rollups(cur, conn, rebuild=rebuild)
+                last_maintenance = now
+                loaded = 0
+                rebuild = False
+
+            if now - last_report >= args.report:
+                summary = metrics.report()
+                print(match_rate(summary['counts']))
+                metrics.reset()
+                last_report = now
+
+            files = watcher.poll()
+            if files:
+                # users are merged per batch, so their level is current
+                reloads = metrics.counts.get('files_reloaded', 0)
+                files_loaded = ingest(cur, conn, files, func)
+                rebuild |= metrics.counts.get('files_reloaded', 0) > reloads
+                if files_loaded:
+                    merge_user_events(cur, conn)
+                loaded += files_loaded
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+        metrics.report()
+        if metrics.sink:
+            metrics.sink.close()
+
+
+if __name__ == "__main__":
+    main()